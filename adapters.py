@@ -0,0 +1,112 @@
+from dataclasses import MISSING, fields
+from enum import Enum
+from types import NoneType, UnionType
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Type,
+    TypeVar,
+    Union,
+    get_args,
+    get_origin,
+    get_type_hints,
+)
+
+from pydantic import TypeAdapter
+
+T = TypeVar("T")
+
+# Compiling the validator is the costly part of a TypeAdapter, it is done once per type,
+# the first time it is needed, instead of on every call
+adapters: Dict[Any, TypeAdapter] = {}
+
+primitives = (str, int, float, bool, NoneType, Any)
+
+# The cheap constructor of each model, None for the ones that aren't flat
+builders: Dict[type, Callable[[Dict], Any] | None] = {}
+
+
+def adapter(tp: Any) -> TypeAdapter:
+    """
+    The adapter of a model, or of a type built from models like List[Business].
+    """
+    ta = adapters.get(tp)
+    if ta is None:
+        ta = TypeAdapter(tp)
+        adapters[tp] = ta
+    return ta
+
+
+def _value(tp: Any, expr: str, ns: Dict[str, Any]) -> str | None:
+    """
+    The expression turning expr into a value of the type, None when it takes more than
+    looking up an enum member.
+    """
+    if tp in primitives:
+        return expr
+    if isinstance(tp, type) and issubclass(tp, Enum):
+        name = f"_e{len(ns)}"
+        ns[name] = tp._value2member_map_
+        return f"{name}[{expr}]"
+    origin, args = get_origin(tp), get_args(tp)
+    if origin is list:
+        _t = _value(args[0], "z", ns)
+        if _t is None:
+            return None
+        return expr if _t == "z" else f"[{_t} for z in {expr}]"
+    if origin in (Union, UnionType):
+        if all(z in primitives for z in args):
+            return expr
+        if len(args) == 2 and NoneType in args:
+            _t = _value(next(z for z in args if z is not NoneType), expr, ns)
+            if _t is None:
+                return None
+            return expr if _t == expr else f"(None if {expr} is None else {_t})"
+    return None
+
+
+def _builder(cls: type) -> Callable[[Dict], Any] | None:
+    """
+    Generates a function setting the fields of cls straight from a dict, defaults are
+    filled in but nothing is validated. Only for flat models, of primitives, enums and
+    lists of those.
+    """
+    # With the Annotated extras, so models having field validators aren't counted as flat
+    hints = get_type_hints(cls, include_extras=True)
+    ns: Dict[str, Any] = {"cls": cls, "new": object.__new__}
+    lines = ["def build(d):", "    o = new(cls)"]
+    for f in fields(cls):
+        name = f"_d{len(ns)}"
+        if f.default is not MISSING:
+            ns[name] = f.default
+            lines.append(f"    v = d.get({f.name!r}, {name})")
+        elif f.default_factory is not MISSING:
+            ns[name] = f.default_factory
+            lines.append(f"    v = d[{f.name!r}] if {f.name!r} in d else {name}()")
+        else:
+            lines.append(f"    v = d[{f.name!r}]")
+        _t = _value(hints[f.name], "v", ns)
+        if _t is None:
+            return None
+        lines.append(f"    o.{f.name} = {_t}")
+    lines.append("    return o")
+    exec("\n".join(lines), ns)
+    return ns["build"]
+
+
+def trusted(cls: Type[T], data: Dict) -> T:
+    """
+    Builds the model from firestore data this API wrote itself, skipping the validation.
+    Models that aren't flat, and data missing a required field or holding an unknown enum
+    value, go through the full validation instead.
+    """
+    if cls not in builders:
+        builders[cls] = _builder(cls)
+    build = builders[cls]
+    if build is not None:
+        try:
+            return build(data)
+        except (AttributeError, KeyError, TypeError) as _:
+            pass
+    return adapter(cls).validate_python(data)
@@ -0,0 +1,96 @@
+from asyncio import to_thread
+from hashlib import sha256
+from logging import getLogger
+from os import environ
+from threading import Event, Lock, Thread
+from time import time
+from typing import Any, Dict
+
+from cachetools import TLRUCache
+from firebase_admin import auth
+
+from database import offline, verify_id_token
+from model import TokenCacheStats
+
+logger = getLogger("lookahead.auth")
+
+# Verified tokens kept, the least recently used are dropped first when it's full
+max_tokens = int(environ.get("LOOKAHEAD_TOKEN_CACHE_SIZE", "10000"))
+# Seconds between refreshes of the certificates tokens are signed with
+cert_refresh_secs = float(environ.get("LOOKAHEAD_CERT_REFRESH_SECS", "600"))
+
+
+def _expires_at(_: Any, decoded_token: Dict, now: float) -> float:
+    return float(decoded_token.get("exp", now))
+
+
+# Keyed by a hash of the token, an entry lives until the token expires
+tokens: TLRUCache = TLRUCache(maxsize=max_tokens, ttu=_expires_at, timer=time)
+tokens_lock = Lock()
+stats = TokenCacheStats(maxSize=max_tokens)
+
+cert_refresher: Thread | None = None
+cert_refresher_lock = Lock()
+stop_refreshing = Event()
+
+
+def refresh_certs() -> None:
+    """
+    Fetches the token signing certificates through the same cache-control aware session
+    firebase_admin verifies with, so an expired copy is replaced here and not while a
+    request waits. This reaches into firebase_admin internals, when they change the
+    refresh only stops and verification fetches the certificates itself as before.
+    """
+    try:
+        verifier = auth._get_client(None)._token_verifier
+        _ = verifier.request(verifier.id_token_verifier.cert_url)
+        stats.certRefreshes += 1
+    except Exception as e:
+        stats.certRefreshFailures += 1
+        logger.warning(f"Refreshing the token certificates failed: {e}")
+
+
+def _refresh_certs_forever() -> None:
+    while True:
+        refresh_certs()
+        if stop_refreshing.wait(cert_refresh_secs):
+            break
+
+
+def start_cert_refresher() -> None:
+    global cert_refresher
+    if offline or cert_refresher is not None:
+        return
+    with cert_refresher_lock:
+        if cert_refresher is None:
+            cert_refresher = Thread(
+                target=_refresh_certs_forever, name="cert-refresher", daemon=True
+            )
+            cert_refresher.start()
+
+
+async def verify_token(id_token: str) -> Dict:
+    """
+    verify_id_token with the verified tokens remembered until they expire, a token seen
+    before costs a hash and a lookup. Verifying a new one runs off the event loop.
+    """
+    key = sha256(id_token.encode()).digest()
+    with tokens_lock:
+        decoded_token = tokens.get(key)
+        if decoded_token is not None:
+            stats.hits += 1
+        else:
+            stats.misses += 1
+    if decoded_token is not None:
+        return decoded_token
+    start_cert_refresher()
+    decoded_token = await to_thread(verify_id_token, id_token)
+    with tokens_lock:
+        tokens[key] = decoded_token
+    return decoded_token
+
+
+def get_token_cache_stats() -> TokenCacheStats:
+    with tokens_lock:
+        stats.size = len(tokens)
+    return TokenCacheStats(**vars(stats))
@@ -0,0 +1,99 @@
+"""
+Cold start profile: how long importing main takes, broken down by the modules it pulls in,
+and the time until a fresh process has answered its first request. Each run is a new
+interpreter, the best of the runs is kept per module. Also lists whether the integrations
+meant to load on first use were imported at startup.
+
+    LOOKAHEAD_STORAGE=memory python benchmarks/import_profile.py [runs] [modules shown]
+"""
+
+from os import environ
+from re import compile
+from subprocess import run
+from sys import argv, executable
+from typing import Dict, List, Tuple
+
+environ.setdefault("LOOKAHEAD_STORAGE", "memory")
+
+lazy_modules = [
+    "chatgpt",
+    "langchain",
+    "telnyx",
+    "firebase_admin.messaging",
+    "phonenumbers",
+]
+
+first_request = """
+from time import perf_counter
+t = perf_counter()
+import sys
+import main
+from fastapi.testclient import TestClient
+imported = perf_counter() - t
+TestClient(main.app).get("/docs")
+print(imported * 1000, (perf_counter() - t) * 1000)
+print(",".join(z for z in {lazy} if z in sys.modules))
+"""
+
+line = compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def profile() -> Dict[str, Tuple[int, int]]:
+    """
+    Cumulative microseconds and nesting depth of every module imported by main.
+    """
+    _t = run(
+        [executable, "-X", "importtime", "-c", "import main"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules: Dict[str, Tuple[int, int]] = {}
+    for z in _t.stderr.splitlines():
+        m = line.match(z)
+        if m is not None:
+            modules[m.group(4)] = (int(m.group(2)), (len(m.group(3)) - 1) // 2)
+    return modules
+
+
+def main(runs: int, shown: int) -> None:
+    best: Dict[str, Tuple[int, int]] = {}
+    for _ in range(runs):
+        for name, (us, depth) in profile().items():
+            if name not in best or us < best[name][0]:
+                best[name] = (us, depth)
+    total = best["main"][0]
+    # What main imports directly, the cost of each including everything under it
+    direct: List[Tuple[str, int]] = sorted(
+        ((k, v[0]) for k, v in best.items() if v[1] == 1), key=lambda z: -z[1]
+    )
+    print(f"import main{total / 1000:>30.1f} ms")
+    for name, us in direct[:shown]:
+        print(f"  {name:<30}{us / 1000:>9.1f} ms{us / total * 100:>6.0f}%")
+
+    timings: List[Tuple[float, float]] = []
+    loaded = ""
+    for _ in range(runs):
+        _t = run(
+            [executable, "-c", first_request.format(lazy=lazy_modules)],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        out = _t.stdout.splitlines()
+        imported, answered = map(float, out[0].split())
+        timings.append((imported, answered))
+        loaded = out[1] if len(out) > 1 else ""
+    imported, answered = min(timings, key=lambda z: z[1])
+    print(
+        f"first request answered after{answered:>13.1f} ms ({imported:.1f} importing)"
+    )
+    for z in lazy_modules:
+        print(f"  {z:<30}{'loaded' if z in loaded.split(',') else 'not loaded':>12}")
+
+
+if __name__ == "__main__":
+    main(
+        int(argv[1]) if len(argv) > 1 else 5,
+        int(argv[2]) if len(argv) > 2 else 15,
+    )
@@ -0,0 +1,154 @@
+"""
+Per request cost of the auth/CORS middleware, the BaseHTTPMiddleware pair it replaced
+against middleware.AuthMiddleware, on an app with a single trivial endpoint.
+Requests are driven straight through ASGI so only the app and its middleware are timed.
+
+    LOOKAHEAD_STORAGE=memory LOOKAHEAD_UNSIGNED_TOKENS=1 python benchmarks/middleware_overhead.py [requests]
+"""
+
+from asyncio import Event, run
+from os import environ
+from sys import argv, path
+from time import perf_counter
+
+environ.setdefault("LOOKAHEAD_STORAGE", "memory")
+environ.setdefault("LOOKAHEAD_UNSIGNED_TOKENS", "1")
+path.insert(0, ".")
+
+from fastapi import FastAPI, Request  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from starlette.responses import Response  # noqa: E402
+
+from auth_cache import verify_token  # noqa: E402
+from la_token import bzz_uid, get_auth_tokens  # noqa: E402
+from middleware import AuthMiddleware, firestore_headers  # noqa: E402
+from opstats import finish_request, start_request  # noqa: E402
+
+
+def endpoint_app() -> FastAPI:
+    app = FastAPI()
+
+    @app.get("/ping")
+    async def ping(request: Request):
+        return {"email": request.state.decoded_token.get("email")}
+
+    return app
+
+
+def legacy_app() -> FastAPI:
+    # The middleware as it was before AuthMiddleware, trimmed to what runs per request
+    app = endpoint_app()
+
+    def add_cors_headers(response: Response) -> Response:
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Methods"] = (
+            "GET, POST, PUT, DELETE, OPTIONS"
+        )
+        response.headers["Access-Control-Allow-Headers"] = "*"
+        response.headers["Access-Control-Expose-Headers"] = ", ".join(firestore_headers)
+        return response
+
+    @app.middleware("http")
+    async def auth_mw(request: Request, call_next):
+        accesskey = request.headers.get("accesskey")
+        try:
+            request.state.decoded_token = await verify_token(accesskey)
+            return add_cors_headers(await call_next(request))
+        except Exception as e:
+            return add_cors_headers(JSONResponse(content={"message": str(e)}))
+
+    @app.middleware("http")
+    async def opstats_mw(request: Request, call_next):
+        stats = start_request()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        response.headers.update(
+            finish_request(
+                f"{request.method} {route.path}" if route is not None else None, stats
+            )
+        )
+        return response
+
+    return app
+
+
+def asgi_app():
+    app = endpoint_app()
+    app.add_middleware(AuthMiddleware)
+    return app
+
+
+async def measure(app, token: str, method: str, n: int) -> float:
+    scope_headers = [(b"accesskey", token.encode())]
+    if method == "OPTIONS":
+        scope_headers.append((b"access-control-request-method", b"GET"))
+
+    def receiver():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            # Nothing more to read, like a client waiting for the response
+            await Event().wait()
+
+        return receive
+
+    async def send(_):
+        pass
+
+    def scope():
+        return {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": "/ping",
+            "raw_path": b"/ping",
+            "query_string": b"",
+            "root_path": "",
+            "headers": list(scope_headers),
+            "client": ("127.0.0.1", 1),
+            "server": ("127.0.0.1", 80),
+        }
+
+    for _ in range(200):
+        await app(scope(), receiver(), send)
+    t = perf_counter()
+    for _ in range(n):
+        await app(scope(), receiver(), send)
+    return (perf_counter() - t) / n * 1e6
+
+
+async def main(n: int, rounds: int = 5) -> None:
+    token = get_auth_tokens(uid=bzz_uid)[1]
+    bare = endpoint_app()
+
+    async def no_auth(scope, receive, send):
+        scope.setdefault("state", {})["decoded_token"] = await verify_token(token)
+        await bare(scope, receive, send)
+
+    runs = [
+        ("no middleware GET", no_auth, "GET"),
+        ("BaseHTTPMiddleware x2 GET", legacy_app(), "GET"),
+        ("BaseHTTPMiddleware x2 OPTIONS", legacy_app(), "OPTIONS"),
+        ("AuthMiddleware GET", asgi_app(), "GET"),
+        ("AuthMiddleware OPTIONS", asgi_app(), "OPTIONS"),
+    ]
+    # Rounds are interleaved and the best one kept, to even out warm up and noise
+    best = {name: float("inf") for name, _, _ in runs}
+    for _ in range(rounds):
+        for name, app, method in runs:
+            best[name] = min(best[name], await measure(app, token, method, n))
+    baseline = best["no middleware GET"]
+    for name, _, _ in runs:
+        print(
+            f"{name:<32}{best[name]:>9.1f} us/request{best[name] - baseline:>+9.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    run(main(int(argv[1]) if len(argv) > 1 else 5000))
@@ -0,0 +1,99 @@
+"""
+Per document cost of turning firestore data into models: a TypeAdapter built for every
+document as the list endpoints used to, a prebuilt one from adapters.adapter, and
+adapters.trusted.
+
+    python benchmarks/model_decode.py [documents]
+"""
+
+from dataclasses import asdict
+from sys import argv, path
+from time import perf_counter
+from typing import Any, Callable, Dict, List
+
+path.insert(0, ".")
+
+from pydantic import TypeAdapter  # noqa: E402
+
+from adapters import adapter, trusted  # noqa: E402
+from model import (  # noqa: E402
+    BusinessUser,
+    BusinessUserRole,
+    ClientModel,
+    DatabaseCalendar,
+    DatabaseEvent,
+    EventStatus,
+    Todo,
+    TodoStatus,
+)
+
+samples: Dict[type, Dict[str, Any]] = {
+    DatabaseEvent: asdict(
+        DatabaseEvent(
+            calendarId="c",
+            summary="Haircut",
+            description="",
+            status=EventStatus.confirmed,
+            customer="+14155550100",
+            startTime=1700000000000,
+            endTime=1700001800000,
+        )
+    ),
+    DatabaseCalendar: asdict(
+        DatabaseCalendar(
+            calendarName="Main",
+            timeZone="America/New_York",
+            opens="09:00",
+            closes="17:00",
+            daysOpen=[True] * 5 + [False] * 2,
+            description="",
+            durationMins=30,
+            breakMins=0,
+        )
+    ),
+    ClientModel: asdict(ClientModel(phone="+14155550100", name="John", group="vip")),
+    Todo: asdict(
+        Todo(
+            msg="Call back",
+            onUTCMins="0",
+            note="",
+            status=TodoStatus.PENDING,
+            todoID="t",
+            creator="+14155550100",
+            createdUTCMins=0,
+            updatedUTCMins=0,
+        )
+    ),
+    BusinessUser: asdict(
+        BusinessUser(email="a@b.c", business="b@b.c", roles=[BusinessUserRole.Admin])
+    ),
+}
+
+
+def measure(fn: Callable[[Dict], Any], docs: List[Dict]) -> float:
+    t = perf_counter()
+    for z in docs:
+        fn(z)
+    return (perf_counter() - t) / len(docs) * 1e6
+
+
+def main(n: int, rounds: int = 5) -> None:
+    print(f"{'':<18}{'inline':>12}{'prebuilt':>12}{'trusted':>12}  us/document")
+    for cls, data in samples.items():
+        docs = [dict(data) for _ in range(n)]
+        runs = {
+            "inline": lambda z: TypeAdapter(cls).validate_python(z),
+            "prebuilt": lambda z: adapter(cls).validate_python(z),
+            "trusted": lambda z: trusted(cls, z),
+        }
+        best = {name: float("inf") for name in runs}
+        for _ in range(rounds):
+            for name, fn in runs.items():
+                # Building an adapter is slow enough that a tenth of the documents tell
+                _docs = docs[: max(1, n // 10)] if name == "inline" else docs
+                best[name] = min(best[name], measure(fn, _docs))
+        print(f"{cls.__name__:<18}" + "".join(f"{best[z]:>12.1f}" for z in runs))
+
+
+if __name__ == "__main__":
+    main(int(argv[1]) if len(argv) > 1 else 5000)
@@ -0,0 +1,108 @@
+"""
+Peak memory of the result sets the list and search endpoints build, with the slotted
+models against the same models with a per instance __dict__, measured with tracemalloc.
+
+    python benchmarks/model_memory.py [items]
+"""
+
+from dataclasses import Field, field, fields, make_dataclass
+from sys import argv, path
+from tracemalloc import get_traced_memory, start, stop
+from typing import Any, Callable, Dict, List
+
+path.insert(0, ".")
+
+from model import (  # noqa: E402
+    ClientModel,
+    DatabaseEvent,
+    Event,
+    EventStatus,
+    Slot,
+    SlotHolder,
+)
+
+
+def _field(f: Field) -> Any:
+    return field(default=f.default, default_factory=f.default_factory)
+
+
+def with_dict(cls: type) -> type:
+    """
+    The model as it was before being slotted, a plain dataclass with the same fields.
+    """
+    return make_dataclass(
+        cls.__name__, [(f.name, f.type, _field(f)) for f in fields(cls)], kw_only=True
+    )
+
+
+def result_sets(n: int, models: Dict[str, type]) -> Dict[str, Callable[[], Any]]:
+    _event, _slot, _holder, _client = (
+        models["DatabaseEvent"],
+        models["Slot"],
+        models["SlotHolder"],
+        models["ClientModel"],
+    )
+    return {
+        "appointments": lambda: [
+            _event(
+                calendarId="c",
+                summary="Haircut",
+                description="",
+                status=EventStatus.confirmed,
+                customer="+14155550100",
+                startTime=1700000000000 + i,
+                endTime=1700001800000 + i,
+                eventId=f"e{i}",
+                updatedAt=i,
+            )
+            for i in range(n)
+        ],
+        "search events": lambda: [
+            models["Event"](eventId=f"e{i}", startTime=i, endTime=i + 1)
+            for i in range(n)
+        ],
+        "search slots": lambda: [
+            _holder(
+                calendarId=f"c{j}",
+                calendarName="Main",
+                timeZone="America/New_York",
+                opens="09:00",
+                closes="17:00",
+                items=[_slot(startTime=i, endTime=i + 1) for i in range(n // 4)],
+            )
+            for j in range(4)
+        ],
+        "clients": lambda: [
+            _client(phone=f"+1415{i:07}", name=f"Client {i}", createTimeUTCSecs=i)
+            for i in range(n)
+        ],
+    }
+
+
+def peak(build: Callable[[], Any]) -> int:
+    start()
+    _t = build()
+    _, highest = get_traced_memory()
+    stop()
+    del _t
+    return highest
+
+
+def main(n: int) -> None:
+    slotted = {
+        z.__name__: z for z in (DatabaseEvent, Event, Slot, SlotHolder, ClientModel)
+    }
+    dicts = {k: with_dict(v) for k, v in slotted.items()}
+    before, after = result_sets(n, dicts), result_sets(n, slotted)
+    print(f"{n} items{'':<10}{'__dict__':>12}{'slots':>12}{'saved':>9}  KiB peak")
+    rows: List[str] = []
+    for name in before:
+        b, a = peak(before[name]), peak(after[name])
+        rows.append(
+            f"{name:<20}{b / 1024:>12.0f}{a / 1024:>12.0f}{(b - a) / b * 100:>8.0f}%"
+        )
+    print("\n".join(rows))
+
+
+if __name__ == "__main__":
+    main(int(argv[1]) if len(argv) > 1 else 10000)
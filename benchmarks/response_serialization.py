@@ -0,0 +1,157 @@
+"""
+Per request cost of serializing the list heavy responses, FastAPI's JSONResponse against
+the ORJSONResponse the app uses by default. Each endpoint returns a prebuilt response of
+the given number of items, requests are driven straight through ASGI.
+
+    python benchmarks/response_serialization.py [items]
+"""
+
+from asyncio import Event, run
+from sys import argv, path
+from time import perf_counter
+from typing import Any, Dict, List, Type
+
+path.insert(0, ".")
+
+from fastapi import FastAPI  # noqa: E402
+from fastapi.responses import JSONResponse, ORJSONResponse, Response  # noqa: E402
+
+from model import (  # noqa: E402
+    ClientModel,
+    ClientsModelResponse,
+    DatabaseEvent,
+    EventStatus,
+    GetAppointmentsResponse,
+    SearchAppointmentResponse,
+    Slot,
+    SlotHolder,
+)
+
+
+def responses(n: int) -> Dict[str, Any]:
+    return {
+        "/appointments": GetAppointmentsResponse(
+            success=True,
+            items=[
+                DatabaseEvent(
+                    calendarId="c",
+                    summary=f"Appointment {i}",
+                    description="",
+                    status=EventStatus.confirmed,
+                    customer="+14155550100",
+                    startTime=1700000000000 + i * 1800000,
+                    endTime=1700001800000 + i * 1800000,
+                )
+                for i in range(n)
+            ],
+        ),
+        "/search": SearchAppointmentResponse(
+            success=True,
+            slots=[
+                SlotHolder(
+                    calendarId=f"c{j}",
+                    calendarName="Main",
+                    timeZone="America/New_York",
+                    opens="09:00",
+                    closes="17:00",
+                    items=[
+                        Slot(
+                            startTime=1700000000000 + i * 1800000,
+                            endTime=1700001800000 + i * 1800000,
+                        )
+                        for i in range(n // 4)
+                    ],
+                )
+                for j in range(4)
+            ],
+            query=None,
+        ),
+        "/clients": ClientsModelResponse(
+            success=True,
+            clients=[
+                ClientModel(phone=f"+1415555{i:04}", name=f"Client {i}", group="vip")
+                for i in range(n)
+            ],
+        ),
+    }
+
+
+def endpoint_app(response_class: Type[Response], n: int) -> FastAPI:
+    app = FastAPI(default_response_class=response_class)
+    _t = responses(n)
+
+    @app.get("/appointments")
+    async def appointments() -> GetAppointmentsResponse:
+        return _t["/appointments"]
+
+    @app.get("/search")
+    async def search() -> SearchAppointmentResponse:
+        return _t["/search"]
+
+    @app.get("/clients")
+    async def clients() -> ClientsModelResponse:
+        return _t["/clients"]
+
+    return app
+
+
+async def measure(app: FastAPI, route: str, n: int) -> float:
+    def receiver():
+        sent = False
+
+        async def receive():
+            nonlocal sent
+            if not sent:
+                sent = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await Event().wait()
+
+        return receive
+
+    async def send(_):
+        pass
+
+    def scope():
+        return {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": "GET",
+            "scheme": "http",
+            "path": route,
+            "raw_path": route.encode(),
+            "query_string": b"",
+            "root_path": "",
+            "headers": [],
+            "client": ("127.0.0.1", 1),
+            "server": ("127.0.0.1", 80),
+        }
+
+    for _ in range(5):
+        await app(scope(), receiver(), send)
+    t = perf_counter()
+    for _ in range(n):
+        await app(scope(), receiver(), send)
+    return (perf_counter() - t) / n * 1e3
+
+
+async def main(items: int, requests: int = 20, rounds: int = 5) -> None:
+    apps = {
+        "JSONResponse": endpoint_app(JSONResponse, items),
+        "ORJSONResponse": endpoint_app(ORJSONResponse, items),
+    }
+    routes: List[str] = list(responses(0).keys())
+    best = {(r, a): float("inf") for r in routes for a in apps}
+    for _ in range(rounds):
+        for route in routes:
+            for name, app in apps.items():
+                best[(route, name)] = min(
+                    best[(route, name)], await measure(app, route, requests)
+                )
+    print(f"{items} items{'':<8}" + "".join(f"{z:>18}" for z in apps) + "  ms/request")
+    for route in routes:
+        print(f"{route:<20}" + "".join(f"{best[(route, z)]:>18.2f}" for z in apps))
+
+
+if __name__ == "__main__":
+    run(main(int(argv[1]) if len(argv) > 1 else 500))
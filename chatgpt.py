@@ -5,9 +5,9 @@ from arrow import get
 from demjson3 import encode
 from langchain.chat_models import ChatOpenAI
 from langchain.schema import HumanMessage, SystemMessage
-from pydantic import TypeAdapter
 from tenacity import retry, retry_if_result, stop_after_attempt
 
+from adapters import adapter
 from constants import api_key, date_format, model_name
 from model import Output
 
@@ -168,7 +168,7 @@ class AIInterpreter:
             try:
                 _temp = loads(outjson)
                 _temp["userRequest"] = q
-                output = TypeAdapter(Output).validate_python(_temp)
+                output = adapter(Output).validate_python(_temp)
 
                 if (
                     is_valid_date(output.startDate, df)
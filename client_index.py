@@ -0,0 +1,149 @@
+from bisect import bisect_left, insort
+from heapq import nsmallest
+from os import environ
+from re import findall, sub
+from typing import Dict, List, Set, Tuple
+from unicodedata import combining, normalize
+
+from cachetools import TTLCache
+
+from clients import get_clients_page
+from model import ClientModel
+from singleflight import SingleFlight
+
+# Seconds an index is used before it is rebuilt, picks up writes made by other instances
+index_ttl = float(environ.get("LOOKAHEAD_CLIENT_INDEX_TTL", "300"))
+# Businesses whose index is kept in memory, the least recently built are dropped first
+max_indexes = int(environ.get("LOOKAHEAD_CLIENT_INDEX_MAX", "256"))
+
+indexes: TTLCache = TTLCache(maxsize=max_indexes, ttl=index_ttl)
+
+index_flight = SingleFlight("build_client_index", timeout=60)
+
+
+def normalize_text(text: str) -> str:
+    """
+    Case folded and without accents, "Zoë" and "zoe" are the same.
+    """
+    return "".join(z for z in normalize("NFKD", text.casefold()) if not combining(z))
+
+
+def query_tokens(q: str) -> List[str]:
+    # A phone number however it is typed, "+1 (415) 555" is one run of digits
+    digits = sub(r"[\s+\-().]", "", q)
+    if digits.isdigit():
+        return [digits]
+    return findall(r"\w+", normalize_text(q))
+
+
+def client_terms(cm: ClientModel) -> Set[str]:
+    terms: Set[str] = set()
+    for z in (cm.name, cm.email, cm.group):
+        if z is not None:
+            terms.update(findall(r"\w+", normalize_text(z)))
+    digits = sub(r"\D", "", cm.phone)
+    if digits != "":
+        terms.add(digits)
+        # Without the country code as well, numbers are usually typed the national way
+        if len(digits) > 10:
+            terms.add(digits[-10:])
+    return terms
+
+
+class ClientIndex:
+    """
+    The clients of a business and a sorted array of (term, phone) over their normalized
+    name, email and group words and phone digits. A search is a bisect per query word.
+    """
+
+    def __init__(self, clients: List[ClientModel]) -> None:
+        self.clients: Dict[str, ClientModel] = {}
+        self.terms: Dict[str, Set[str]] = {}
+        self.order: Dict[str, Tuple[str, str]] = {}
+        self.keys: List[Tuple[str, str]] = []
+        for cm in clients:
+            self.clients[cm.phone] = cm
+            self.terms[cm.phone] = client_terms(cm)
+            self.order[cm.phone] = (normalize_text(cm.name or ""), cm.phone)
+            self.keys.extend((z, cm.phone) for z in self.terms[cm.phone])
+        self.keys.sort()
+
+    def put(self, cm: ClientModel) -> None:
+        self.remove(cm.phone)
+        self.clients[cm.phone] = cm
+        self.terms[cm.phone] = client_terms(cm)
+        self.order[cm.phone] = (normalize_text(cm.name or ""), cm.phone)
+        for z in self.terms[cm.phone]:
+            insort(self.keys, (z, cm.phone))
+
+    def remove(self, phone: str) -> None:
+        self.clients.pop(phone, None)
+        self.order.pop(phone, None)
+        for z in self.terms.pop(phone, set()):
+            i = bisect_left(self.keys, (z, phone))
+            if i < len(self.keys) and self.keys[i] == (z, phone):
+                del self.keys[i]
+
+    def _prefixed(self, prefix: str) -> Set[str]:
+        phones: Set[str] = set()
+        i = bisect_left(self.keys, (prefix, ""))
+        while i < len(self.keys) and self.keys[i][0].startswith(prefix):
+            phones.add(self.keys[i][1])
+            i += 1
+        return phones
+
+    def search(self, q: str, limit: int) -> List[ClientModel]:
+        """
+        Clients having a word starting with every word of the query, ordered by name.
+        """
+        tokens = query_tokens(q)
+        if len(tokens) == 0:
+            return []
+        phones = self._prefixed(tokens[0])
+        for z in tokens[1:]:
+            if len(phones) == 0:
+                break
+            phones &= self._prefixed(z)
+        return [
+            self.clients[z]
+            for z in nsmallest(limit, phones, key=self.order.__getitem__)
+        ]
+
+
+def build_index(business: str) -> ClientIndex:
+    clients: List[ClientModel] = []
+    after: str | None = None
+    while True:
+        page, after = get_clients_page(business=business, limit=500, after=after)
+        clients.extend(filter(lambda z: z.phone != "+10000000000", page))
+        if after is None:
+            break
+    return ClientIndex(clients)
+
+
+async def get_index(business: str) -> ClientIndex:
+    """
+    The index of the business, built on first use and again once it is index_ttl old.
+    """
+    index = indexes.get(business)
+    if index is None:
+        index = await index_flight.do(business, lambda: build_index(business))
+        indexes[business] = index
+    return index
+
+
+def put_client(business: str, cm: ClientModel) -> None:
+    # Indexes not built yet are left alone, they will read the client when they are
+    index = indexes.get(business)
+    if index is not None and cm.phone != "+10000000000":
+        index.put(cm)
+
+
+def remove_client(business: str, phone: str) -> None:
+    index = indexes.get(business)
+    if index is not None:
+        index.remove(phone)
+
+
+def invalidate(business: str) -> None:
+    indexes.pop(business, None)
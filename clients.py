@@ -0,0 +1,278 @@
+from asyncio import Semaphore, create_task, gather, to_thread
+from codecs import getincrementaldecoder
+from collections import deque
+from csv import Error, reader
+from dataclasses import asdict
+from json import loads
+from typing import Any, AsyncIterator, Deque, Dict, List, Tuple
+
+from pydantic import ValidationError
+
+from adapters import adapter, trusted
+from database import fsdb, get_docs
+from jobs import is_deleted
+from model import (
+    Business,
+    ClientImportResult,
+    ClientImportStatus,
+    ClientModel,
+    MinimalClientModel,
+)
+from uow import UnitOfWork
+
+
+def get_lastLogin(user_doc: Dict | None) -> str | None:
+    return user_doc.get("last_login") if user_doc is not None else None
+
+
+async def with_lastLogin(clients: List[ClientModel]) -> List[ClientModel]:
+    """
+    Fills the lastLogin of the clients with one chunked multi-document read of their users.
+    """
+    users = await get_docs([f"users/{z.phone}" for z in clients])
+    for cm, user_doc in zip(clients, users):
+        lastLogin = get_lastLogin(user_doc)
+        if lastLogin is not None:
+            cm.lastLogin = lastLogin
+    return clients
+
+
+def get_clients_page(
+    business: str, limit: int, after: str | None = None
+) -> Tuple[List[ClientModel], str | None]:
+    """
+    A page of the business's clients ordered by phone, starting after the given phone.
+    Also returns the phone to continue from, None when this was the last page.
+    """
+    query = (
+        fsdb.collection(f"businesses/{business}/clients").order_by("phone").limit(limit)
+    )
+    if after is not None:
+        query = query.start_after({"phone": after})
+    docs = [z.to_dict() for z in query.get()]
+    last = docs[-1].get("phone") if len(docs) > 0 and len(docs) == limit else None
+    clients = [trusted(ClientModel, z) for z in docs if not is_deleted(z)]
+    return clients, last
+
+
+async def iter_clients(
+    business: str, chunk_size: int = 500
+) -> AsyncIterator[List[ClientModel]]:
+    """
+    Walks every client of the business in chunks, only one chunk is held at a time.
+    """
+    after: str | None = None
+    while True:
+        clients, after = await to_thread(get_clients_page, business, chunk_size, after)
+        if len(clients) > 0:
+            yield await with_lastLogin(clients)
+        if after is None:
+            break
+
+
+# Rows of an import looked up and written together, two writes each fill a batch
+import_chunk_size = 250
+# Chunks of an import being written at the same time
+import_concurrency = 4
+
+
+def _error_message(e: Exception) -> str:
+    if isinstance(e, ValidationError):
+        return "; ".join(
+            f"{'.'.join(map(str, z['loc']))}: {z['msg']}" for z in e.errors()
+        )
+    return str(e)
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """
+    The decoded lines of a streamed body, each with its line ending.
+    """
+    decoder = getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for z in lines:
+            yield z + "\n"
+    buffer += decoder.decode(b"", final=True)
+    if buffer != "":
+        yield buffer
+
+
+class _Feed:
+    """
+    The lines handed to the csv reader as they arrive. It is only asked for a record once
+    all of its lines are in, running out never ends the reader.
+    """
+
+    def __init__(self) -> None:
+        self.lines: Deque[str] = deque()
+
+    def __iter__(self) -> "_Feed":
+        return self
+
+    def __next__(self) -> str:
+        if len(self.lines) == 0:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def _csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Dict | Exception]:
+    """
+    The records of a CSV body by its header row, read by one reader so a quoted field
+    may span lines. A record is complete once its quotes are balanced, escaped quotes
+    being doubled.
+    """
+    feed = _Feed()
+    records = reader(feed)
+    header: List[str] | None = None
+    quotes = 0
+    async for line in _lines(chunks):
+        feed.lines.append(line)
+        quotes += line.count('"')
+        if quotes % 2 == 1:
+            continue
+        quotes = 0
+        try:
+            fields = next(records)
+        except Error as e:
+            yield e
+            continue
+        if all(z.strip() == "" for z in fields):
+            continue
+        if header is None:
+            header = [z.strip() for z in fields]
+            continue
+        yield {k: v.strip() for k, v in zip(header, fields) if v.strip() != ""}
+    if len(feed.lines) > 0:
+        yield Error("Unterminated quoted field at the end of the body")
+
+
+async def _ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[Any | Exception]:
+    async for line in _lines(chunks):
+        if line.strip() == "":
+            continue
+        try:
+            yield loads(line)
+        except Exception as e:
+            yield e
+
+
+async def parse_import_rows(
+    chunks: AsyncIterator[bytes], is_csv: bool
+) -> AsyncIterator[Tuple[int, MinimalClientModel | None, str | None]]:
+    """
+    Validates a streamed CSV (with a header row) or NDJSON body record by record.
+    Yields the row number, the client or why the row isn't one. Blank lines are skipped.
+    """
+    row = 0
+    rows = _csv_rows(chunks) if is_csv else _ndjson_rows(chunks)
+    async for _t in rows:
+        row += 1
+        if isinstance(_t, Exception):
+            yield row, None, _error_message(_t)
+            continue
+        try:
+            yield row, adapter(MinimalClientModel).validate_python(_t), None
+        except Exception as e:
+            yield row, None, _error_message(e)
+
+
+async def _import_chunk(
+    bzz: Business, chunk: List[Tuple[int, MinimalClientModel]]
+) -> List[ClientImportResult]:
+    """
+    The phones of a chunk are unique, and no other chunk written at the same time has any
+    of them, see import_clients.
+    """
+    clients_path = f"businesses/{bzz.business}/clients"
+    try:
+        existing = await get_docs([f"{clients_path}/{mcm.phone}" for _, mcm in chunk])
+        uow = UnitOfWork()
+        results: List[ClientImportResult] = []
+        for (row, mcm), _t in zip(chunk, existing):
+            doc_path = f"{clients_path}/{mcm.phone}"
+            if _t is None or is_deleted(_t):
+                _t2 = trusted(ClientModel, asdict(mcm))
+                uow.set(doc_path, asdict(_t2))
+                status = ClientImportStatus.created
+            else:
+                uow.merge(
+                    doc_path,
+                    adapter(MinimalClientModel).dump_python(mcm, exclude_none=True),
+                )
+                status = ClientImportStatus.updated
+            uow.set(f"users/{mcm.phone}/businesses/{bzz.business}", asdict(bzz))
+            results.append(ClientImportResult(row=row, status=status, phone=mcm.phone))
+        await uow.commit()
+        return results
+    except Exception as e:
+        return [
+            ClientImportResult(
+                row=row,
+                status=ClientImportStatus.failed,
+                phone=mcm.phone,
+                error=_error_message(e),
+            )
+            for row, mcm in chunk
+        ]
+
+
+async def import_clients(
+    bzz: Business,
+    rows: AsyncIterator[Tuple[int, MinimalClientModel | None, str | None]],
+) -> List[ClientImportResult]:
+    """
+    Creates or updates the clients of the rows under the business, and links the business
+    under each of them. Rows keep being read while earlier chunks are written, at most
+    import_concurrency chunks at a time. A chunk that fails to commit fails all its rows.
+
+    A phone repeated in the rows goes in a later round, each round written once the one
+    before it is, so every row of a phone applies after the previous one.
+    """
+    results: List[ClientImportResult] = []
+    occurrences: Dict[str, int] = {}
+    repeats: List[List[Tuple[int, MinimalClientModel]]] = []
+    semaphore = Semaphore(import_concurrency)
+    tasks = []
+
+    async def write(chunk: List[Tuple[int, MinimalClientModel]]):
+        try:
+            results.extend(await _import_chunk(bzz, chunk))
+        finally:
+            semaphore.release()
+
+    async def flush(chunk: List[Tuple[int, MinimalClientModel]]):
+        await semaphore.acquire()
+        tasks.append(create_task(write(chunk)))
+
+    chunk: List[Tuple[int, MinimalClientModel]] = []
+    async for row, mcm, error in rows:
+        if mcm is None:
+            results.append(
+                ClientImportResult(
+                    row=row, status=ClientImportStatus.invalid, error=error
+                )
+            )
+            continue
+        n = occurrences.get(mcm.phone, 0)
+        occurrences[mcm.phone] = n + 1
+        if n > 0:
+            if len(repeats) < n:
+                repeats.append([])
+            repeats[n - 1].append((row, mcm))
+            continue
+        chunk.append((row, mcm))
+        if len(chunk) == import_chunk_size:
+            await flush(chunk)
+            chunk = []
+    if len(chunk) > 0:
+        await flush(chunk)
+    _ = await gather(*tasks)
+    for z in repeats:
+        tasks.clear()
+        for i in range(0, len(z), import_chunk_size):
+            await flush(z[i : i + import_chunk_size])
+        _ = await gather(*tasks)
+    return sorted(results, key=lambda z: z.row)
@@ -1,7 +1,34 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from json import dumps, loads
 from string import ascii_letters, ascii_lowercase, ascii_uppercase
+from typing import Dict
 
+from fastapi import HTTPException
 from nanoid import generate
 
 
 def generate_id(length: int = 20) -> str:
     return generate(ascii_letters + ascii_lowercase + ascii_uppercase, length)
+
+
+def encode_cursor(values: Dict) -> str:
+    """
+    Opaque page token out of the values of the last document of a page.
+    """
+    return urlsafe_b64encode(dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, **types: type) -> Dict:
+    """
+    The values of a page token, each of the given keys checked for its type. A malformed
+    token is answered with a 400 rather than failing the request.
+    """
+    try:
+        values = loads(urlsafe_b64decode(cursor.encode()))
+    except ValueError as _:
+        values = None
+    if not isinstance(values, dict) or any(
+        not isinstance(values.get(k), t) for k, t in types.items()
+    ):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
@@ -1,16 +1,172 @@
-from json import loads
-from typing import Dict
-
+from dataclasses import replace
+from logging import getLogger
+from os import environ
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Tuple
+
+from cachetools import TTLCache
 from fastapi import Request
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pydantic import TypeAdapter
 from validators import email as validate_email
 
-from database import fsdb
+from adapters import adapter
+from database import fsdb, select_ids
 from model import Business, Subject
+from singleflight import SingleFlight
+
+business_flight = SingleFlight("get_business")
+
+logger = getLogger("lookahead.auth")
+
+
+# Seconds a secondary user's membership check is trusted, other instances see an added or
+# removed user once their entry expires
+membership_ttl = float(environ.get("LOOKAHEAD_MEMBERSHIP_TTL", "60"))
+
+memberships: TTLCache = TTLCache(maxsize=10000, ttl=membership_ttl)
+memberships_lock = Lock()
+
+membership_flight = SingleFlight("is_business_user")
+
+
+def is_business_user(business: str, email: str) -> bool:
+    _t = (
+        fsdb.collection("businessusers")
+        .where(filter=FieldFilter("business", "==", business))
+        .where(filter=FieldFilter("email", "==", email))
+        .limit(1)
+    )
+    return len(select_ids(_t)) == 1
+
+
+async def is_business_user_cached(business: str, email: str) -> bool:
+    key = (business, email)
+    with memberships_lock:
+        member = memberships.get(key)
+    if member is None:
+        member = await membership_flight.do(
+            key, lambda: is_business_user(business=business, email=email)
+        )
+        with memberships_lock:
+            memberships[key] = member
+    return member
+
+
+def forget_membership(business: str, email: str) -> None:
+    with memberships_lock:
+        memberships.pop((business, email), None)
+
+
+# Removed memberships, the claims of a token aren't trusted for a business the user was
+# removed from after it was issued, nor at all while the claims still hold it
+revocations_col = "revocations"
+# Seconds between reloads of the revocations, how long a removal made on another instance
+# takes to reach the tokens still claiming the business
+revocations_refresh = float(environ.get("LOOKAHEAD_REVOCATIONS_REFRESH", "30"))
+# Firebase ID tokens expire after an hour, older revocations only matter while uncleared
+token_lifetime = 3600
+
+revocations: Dict[Tuple[str, str], Dict] = {}
+revocations_loaded = 0.0
+
+revocations_flight = SingleFlight("revocations")
+
 
+def _revocation_path(business: str, email: str) -> str:
+    return f"{revocations_col}/{email} {business}"
+
+
+def record_revocation(business: str, email: str, claims_cleared: bool) -> None:
+    data = {
+        "business": business,
+        "email": email,
+        "revokedAt": time(),
+        "claimsCleared": claims_cleared,
+    }
+    fsdb.document(_revocation_path(business, email)).set(data)
+    with memberships_lock:
+        revocations[(business, email)] = data
+
+
+def forget_revocation(business: str, email: str) -> None:
+    fsdb.document(_revocation_path(business, email)).delete()
+    with memberships_lock:
+        revocations.pop((business, email), None)
+
+
+def load_revocations() -> Dict[Tuple[str, str], Dict]:
+    col = fsdb.collection(revocations_col)
+    recent = col.where(filter=FieldFilter("revokedAt", ">", time() - token_lifetime))
+    uncleared = col.where(filter=FieldFilter("claimsCleared", "==", False))
+    docs = [z.to_dict() or {} for z in [*recent.get(), *uncleared.get()]]
+    return {(z["business"], z["email"]): z for z in docs}
+
+
+async def refresh_revocations() -> bool:
+    """
+    Reloads the revocations every revocations_refresh seconds. False when they couldn't
+    be, the claims aren't trusted then.
+    """
+    global revocations_loaded
+    if time() - revocations_loaded < revocations_refresh:
+        return True
+    try:
+        loaded = await revocations_flight.do("revocations", load_revocations)
+    except Exception as e:
+        logger.warning(f"Loading the revocations failed: {e}")
+        return False
+    with memberships_lock:
+        revocations.update(loaded)
+        for k, v in list(revocations.items()):
+            if v["claimsCleared"] and v["revokedAt"] < time() - token_lifetime:
+                del revocations[k]
+        revocations_loaded = time()
+    return True
+
+
+def _revoked(revocation: Dict | None, iat: float) -> bool:
+    return revocation is not None and (
+        not revocation["claimsCleared"] or revocation["revokedAt"] >= iat
+    )
+
+
+def claimed_businesses(decoded_token: Dict) -> Dict[str, List[str]] | None:
+    """
+    The businesses and roles in the custom claims of the token, written by
+    BusinessUserManagement, trusted until the token expires unless revoked. None when the
+    token has none or has expired.
+    """
+    businesses = decoded_token.get("businesses")
+    iat = decoded_token.get("iat")
+    exp = decoded_token.get("exp")
+    if (
+        not isinstance(businesses, dict)
+        or not isinstance(iat, (int, float))
+        or not isinstance(exp, (int, float))
+    ):
+        return None
+    if exp <= time():
+        return None
+    email = decoded_token.get("email")
+    with memberships_lock:
+        return {
+            k: v
+            for k, v in businesses.items()
+            if not _revoked(revocations.get((k, email)), iat)
+        }
+
+
+async def find_subject(request: Request, body: Any = None) -> Subject:
+    """
+    Who the request acts for. Resolved once per request, later calls get a copy.
+    The business and phone fall back to the business, user_phone and userPhone fields of
+    the parsed body when the token and headers don't carry them.
+    """
+    resolved: Subject | None = getattr(request.state, "subject", None)
+    if resolved is not None:
+        return replace(resolved)
 
-async def find_subject(request: Request) -> Subject:
     subject = Subject(business=None, phone=None, secondaryUserEmail=None)
     decoded_token = request.state.decoded_token
     requestor_email = decoded_token.get("email")
@@ -24,53 +180,35 @@ async def find_subject(request: Request) -> Subject:
         subject.business = onbehalfof
         subject.secondaryUserEmail = requestor_email
 
-    _body = {}
-    try:
-        _body = loads(await request.body())
-    except Exception as _:
-        pass
-
     if subject.business is None:
-        subject.business = _body.get("business", None)
+        subject.business = getattr(body, "business", None)
 
     if subject.phone is None:
         subject.phone = decoded_token.get("phone_number", None)
     if subject.phone is None:
         subject.phone = decoded_token.get("phoneNumber", None)
     if subject.phone is None:
-        subject.phone = _body.get("user_phone", None)
+        subject.phone = getattr(body, "user_phone", None)
     if subject.phone is None:
-        subject.phone = _body.get("userPhone", None)
+        subject.phone = getattr(body, "userPhone", None)
 
     if subject.secondaryUserEmail == subject.business:
         # When owners of a business make request
         subject.secondaryUserEmail = None
 
     if subject.secondaryUserEmail is not None:
-        _t = (
-            fsdb.collection("businessusers")
-            .where(
-                filter=FieldFilter(
-                    "business",
-                    "==",
-                    subject.business,
-                )
-            )
-            .where(
-                filter=FieldFilter(
-                    "email",
-                    "==",
-                    subject.secondaryUserEmail,
-                )
-            )
-            .limit(1)
-            .get()
+        claimed = (
+            claimed_businesses(decoded_token) if await refresh_revocations() else None
         )
-
-        if len(_t) != 1:
+        if (
+            claimed is None or subject.business not in claimed
+        ) and not await is_business_user_cached(
+            business=subject.business, email=subject.secondaryUserEmail
+        ):
             raise Exception("Unauthorized secondary user")
 
-    return subject
+    request.state.subject = subject
+    return replace(subject)
 
 
 def convert_dict_to_Business_dict(_t: Dict) -> Dict:
@@ -80,10 +218,19 @@ def convert_dict_to_Business_dict(_t: Dict) -> Dict:
 
 def get_business(businessEmail: str) -> Business | None:
     bzz_path = f"businesses/{businessEmail}"
-    _t = fsdb.document(bzz_path).get().to_dict()
+    return to_business(fsdb.document(bzz_path).get().to_dict())
+
+
+async def get_business_coalesced(businessEmail: str) -> Business | None:
+    return await business_flight.do(
+        businessEmail, lambda: get_business(businessEmail=businessEmail)
+    )
+
+
+def to_business(_t: Dict | None) -> Business | None:
     if _t is not None:
         try:
-            return TypeAdapter(Business).validate_python(
+            return adapter(Business).validate_python(
                 convert_dict_to_Business_dict(_t=_t)
             )
         except Exception as _:
@@ -1,26 +1,104 @@
-from typing import List
+from asyncio import gather, to_thread
+from os import environ
+from typing import Dict, List
 
 from firebase_admin import _apps as initialized
-from firebase_admin import credentials, firestore, initialize_app
-from firebase_admin.messaging import (
-    BatchResponse,
-    MulticastMessage,
-    Notification,
-    send_multicast,
-)
-from google.cloud.firestore import Client
-from telnyx import Message
+from firebase_admin import auth, credentials, firestore, initialize_app
+from google.cloud.firestore import CollectionReference, Query
+from google.cloud.firestore_v1.field_path import FieldPath
+from jwt import decode as jwt_decode
 
 from constants import service_account, telnyx_api_key, telnyx_number
 from model import FcmResult, SendNotyf
+from opstats import InstrumentedStorage
+from storage import MemoryStorage, Storage
 
-if not initialized:
-    initialize_app(credential=credentials.Certificate(service_account))
+# LOOKAHEAD_STORAGE=memory runs the api without a firebase project, documents are kept in
+# process and tokens, push notifications and SMS are faked, see la_token.get_auth_tokens
+storage_backend = environ.get("LOOKAHEAD_STORAGE", "firestore")
+offline = storage_backend == "memory"
+# Accepting the unsigned offline tokens is its own switch, for the tests only, so an
+# instance started with the memory storage still authenticates nobody
+unsigned_tokens = offline and environ.get("LOOKAHEAD_UNSIGNED_TOKENS") == "1"
+if unsigned_tokens and environ.get("K_SERVICE") is not None:
+    raise RuntimeError("LOOKAHEAD_UNSIGNED_TOKENS is refused on Cloud Run")
 
-fsdb: Client = firestore.client()
+fsdb: Storage
+if offline:
+    fsdb = InstrumentedStorage(MemoryStorage())
+else:
+    if not initialized:
+        initialize_app(credential=credentials.Certificate(service_account))
+    fsdb = InstrumentedStorage(firestore.client())
+
+
+def verify_id_token(id_token: str) -> Dict:
+    if unsigned_tokens:
+        return jwt_decode(id_token, options={"verify_signature": False})
+    if offline:
+        raise Exception("Tokens can't be verified without firebase")
+    return auth.verify_id_token(id_token)
+
+
+# Upper bound on the documents fetched by a single get_all call
+get_all_chunk_size = 100
+
+
+def _get_all(paths: List[str]) -> Dict[str, Dict | None]:
+    return {
+        z.reference.path: z.to_dict()
+        for z in fsdb.get_all([fsdb.document(p) for p in paths])
+    }
+
+
+async def get_docs(
+    paths: List[str], chunk_size: int = get_all_chunk_size
+) -> List[Dict | None]:
+    """
+    Fetches many documents by path with chunked get_all calls issued concurrently,
+    results are in the same order as the paths and None for the missing ones.
+    """
+    unique = list(dict.fromkeys(paths))
+    tasks = [
+        to_thread(_get_all, unique[i : i + chunk_size])
+        for i in range(0, len(unique), chunk_size)
+    ]
+    docs: Dict[str, Dict | None] = {}
+    for z in await gather(*tasks):
+        docs.update(z)
+    return [docs.get(p) for p in paths]
+
+
+def select_ids(query: Query | CollectionReference) -> List[str]:
+    """
+    Keys only query, the matching documents come back without any of their fields.
+    """
+    return [z.id for z in query.select([FieldPath.document_id()]).get()]
+
+
+def select_fields(query: Query | CollectionReference, fields: List[str]) -> List[Dict]:
+    """
+    Projected query, only the given fields of the matching documents are downloaded.
+    """
+    return [z.to_dict() or {} for z in query.select(fields).get()]
 
 
 async def send_fcm_message(sn: SendNotyf, fcm_tokens: List[str]) -> FcmResult:
+    if offline:
+        return FcmResult(
+            phoneNumber=None,
+            totalTokens=len(fcm_tokens),
+            successCount=len(fcm_tokens),
+            failureCount=0,
+        )
+    # The messaging and SMS clients are imported when first used, to keep cold starts short
+    from firebase_admin.messaging import (
+        BatchResponse,
+        MulticastMessage,
+        Notification,
+        send_multicast,
+    )
+
     message = MulticastMessage(
         tokens=fcm_tokens,
         data={},
@@ -36,6 +114,10 @@ async def send_fcm_message(sn: SendNotyf, fcm_tokens: List[str]) -> FcmResult:
 
 
 async def send_sms(sn: SendNotyf):
+    if offline:
+        return
+    from telnyx import Message
+
     try:
         Message.create(
             api_key=telnyx_api_key,
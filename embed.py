@@ -1,8 +1,10 @@
+from asyncio import gather, to_thread
+from typing import Any
+
 from arrow import get
 from fastapi.routing import APIRouter
 
-from chatgpt import AIInterpreter
-from common2 import get_business
+from common2 import get_business_coalesced
 from constants import date_format, date_format2
 from fbcalendar import FBCalendar
 from model import (
@@ -17,21 +19,31 @@ from model import (
     Subject,
 )
 from notyf import Notyf
+from uow import UnitOfWork
 from utils import cross_sync_business_and_client
 
 router = APIRouter()
 
 
 @router.get("/business")
-def business_info(businessEmail: str) -> Business | None:
-    return get_business(businessEmail=businessEmail)
+async def business_info(businessEmail: str) -> Business | None:
+    return await get_business_coalesced(businessEmail=businessEmail)
+
+
+def _interpret(body: SearchAppointmentRequest) -> Any:
+    # Loaded on the first search, langchain takes longer to import than the rest of the
+    # app and most instances never need it. Imported here, on the thread, so the event
+    # loop isn't held up by it
+    from chatgpt import AIInterpreter
+
+    return AIInterpreter().ask(q=body.request, current_time=body.currentTime)
 
 
 async def handle_search(
     body: SearchAppointmentRequest, subject: Subject
 ) -> SearchAppointmentResponse:
     if subject.business is not None and subject.phone is not None:
-        output = AIInterpreter().ask(q=body.request, current_time=body.currentTime)
+        output = await to_thread(_interpret, body)
         if output is not None:
             return SearchAppointmentResponse(
                 success=True,
@@ -51,8 +63,24 @@ async def handle_create_appointment(
     body: SetAppointmentRequest, subject: Subject
 ) -> SetAppointmentResponse:
     if subject.business is not None and subject.phone is not None:
+        # Every write of the booking is collected here and committed at once
+        uow = UnitOfWork()
         fbc = FBCalendar(subject.business, None)
-        c = fbc.get_calendar(calendarId=body.calendarId)
+        calendar = to_thread(fbc.get_calendar, calendarId=body.calendarId)
+        if body.userPhone is not None:
+            # The client records are read alongside the calendar, their writes are only
+            # queued and go in with the booking
+            c, _ = await gather(
+                calendar,
+                cross_sync_business_and_client(
+                    business=subject.business,
+                    user_phone=body.userPhone,
+                    mcm=MinimalClientModel(name=body.name, phone=body.userPhone),
+                    uow=uow,
+                ),
+            )
+        else:
+            c = await calendar
         if c is not None:
             notyf = Notyf(
                 subject=subject,
@@ -69,20 +97,16 @@ async def handle_create_appointment(
                 status=EventStatus.confirmed
                 if body.query is None
                 else EventStatus.tentative,
+                uow=uow,
             )
-            if body.userPhone is not None:
-                cross_sync_business_and_client(
-                    business=subject.business,
-                    user_phone=body.userPhone,
-                    mcm=MinimalClientModel(name=body.name, phone=body.userPhone),
-                )
             if de is not None:
                 if (
                     de.calendarId is not None
                     and de.eventId is not None
                     and de.status is not None
                 ):
-                    _t3 = await notyf.notify(de=de, cal=c)
+                    _t3 = await notyf.notify(de=de, cal=c, uow=uow)
+                    await uow.commit()
                     if _t3.result is not None and body.sendNotification is True:
                         await Notyf.send_fcm_messages(
                             sns=[
@@ -95,6 +119,7 @@ async def handle_create_appointment(
                             ]
                         )
                     return _t3
+    # No booking was written, the client records queued for it are dropped uncommitted
     return SetAppointmentResponse()
 
 
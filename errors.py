@@ -0,0 +1,41 @@
+from typing import Any, Dict, List, Sequence, Tuple
+
+from cachetools import LRUCache
+
+# The parts of an error that don't depend on the input, by type, location and message.
+# Bad payloads sent in bulk repeat the same few, only their input is rebuilt.
+static_parts: LRUCache = LRUCache(maxsize=1024)
+
+
+def json_safe(value: Any) -> Any:
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, dict):
+        return {str(k): json_safe(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [json_safe(z) for z in value]
+    if isinstance(value, bytes):
+        return value.decode("utf-8", "replace")
+    return str(value)
+
+
+def error_messages(errors: Sequence[Any]) -> List[Dict]:
+    """
+    The errors of a RequestValidationError or ResponseValidationError as JSON ready dicts,
+    with the type, loc, msg, input, ctx and url pydantic reports.
+    """
+    messages: List[Dict] = []
+    for z in errors:
+        loc: Tuple = tuple(z.get("loc", ()))
+        key = (z.get("type"), loc, z.get("msg"))
+        static = static_parts.get(key)
+        if static is None:
+            static = {"type": key[0], "loc": list(loc), "msg": key[2]}
+            if "url" in z:
+                static["url"] = z["url"]
+            static_parts[key] = static
+        message = {**static, "input": json_safe(z.get("input"))}
+        if "ctx" in z:
+            message["ctx"] = json_safe(z["ctx"])
+        messages.append(message)
+    return messages
@@ -1,18 +1,24 @@
+from asyncio import gather, to_thread
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import copy_context
 from dataclasses import asdict
 from time import time
-from typing import List, Tuple
+from typing import Callable, Dict, List, Tuple, TypeVar
 
 from arrow import Arrow, get
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pydantic import TypeAdapter
+from google.cloud.firestore_v1.field_path import FieldPath
 
+from adapters import adapter, trusted
 from common import generate_id
 from database import fsdb
+from jobs import is_deleted, start_delete
 from model import (
     DatabaseCalendar,
     DatabaseEvent,
     Event,
     EventStatus,
+    Job,
     Output,
     Slot,
     SlotHolder,
@@ -21,7 +27,21 @@ from model import (
     UpdateCalendarRequest,
 )
 from notyf import Notyf
+from singleflight import SingleFlight
 from slot_search import SlotSearch
+from uow import UnitOfWork
+
+
+T = TypeVar("T")
+
+# Dashboards and embed widgets ask for the same calendars and events in bursts
+calendars_flight = SingleFlight("get_calendars")
+events_flight = SingleFlight("get_events")
+
+# Reads of the calendar document issued alongside the event queries of a listing
+calendar_checks = ThreadPoolExecutor(
+    max_workers=8, thread_name_prefix="calendar-checks"
+)
 
 
 def get_doc_path(x: str, y: str | None = None, z: str | None = None):
@@ -31,6 +51,70 @@ def get_doc_path(x: str, y: str | None = None, z: str | None = None):
     return f"{_t}/events/{z}" if z is not None else _t
 
 
+# Largest page of events a paged listing returns
+max_events_page_size = 500
+# Events are stamped with the clock of the instance writing them, changes made this close
+# before a sync token are sent again rather than risk missing them
+sync_overlap_ms = 5000
+
+
+def now_ms() -> int:
+    return int(time() * 1000)
+
+
+def _events_query(
+    email: str,
+    calendarId: str,
+    start_date: Arrow,
+    end_date: Arrow,
+    status: EventStatus | None = None,
+    user_phone: str | None = None,
+):
+    query = (
+        fsdb.collection(f"{get_doc_path(email, calendarId)}/events")
+        .where(filter=FieldFilter("startTime", ">=", int(start_date.timestamp())))
+        .where(filter=FieldFilter("startTime", "<=", int(end_date.timestamp())))
+    )
+    if status is not None:
+        query = query.where(filter=FieldFilter("status", "==", status))
+    if user_phone is not None:
+        query = query.where(filter=FieldFilter("customer", "==", user_phone))
+    return query
+
+
+def is_calendar_deleted(email: str, calendarId: str) -> bool:
+    """
+    Whether the calendar is being removed, its events are treated as gone along with it.
+    """
+    return is_deleted(fsdb.document(get_doc_path(email, calendarId)).get().to_dict())
+
+
+def _unless_calendar_deleted(
+    email: str, calendarId: str, fetch: Callable[[], T], gone: T
+) -> T:
+    """
+    Runs fetch while the calendar document is read rather than after it, gone is returned
+    instead when the calendar is being removed. The read counts against the same request.
+    """
+    deleted = calendar_checks.submit(
+        copy_context().run, is_calendar_deleted, email, calendarId
+    )
+    result = fetch()
+    return gone if deleted.result() else result
+
+
+def _list_events(
+    email: str,
+    calendarId: str,
+    start_date: Arrow,
+    end_date: Arrow,
+    status: EventStatus | None = None,
+    user_phone: str | None = None,
+) -> List[DatabaseEvent]:
+    doc_ref = _events_query(email, calendarId, start_date, end_date, status, user_phone)
+    return [trusted(DatabaseEvent, z.to_dict()) for z in doc_ref.get()]
+
+
 def get_events(
     email: str,
     calendarId: str,
@@ -41,22 +125,104 @@ def get_events(
 ) -> List[DatabaseEvent]:
     events: List[DatabaseEvent] = []
     if email is not None:
-        doc_ref = (
-            fsdb.collection(f"{get_doc_path(email, calendarId)}/events")
-            .where(filter=FieldFilter("startTime", ">=", int(start_date.timestamp())))
-            .where(filter=FieldFilter("startTime", "<=", int(end_date.timestamp())))
-        )
-        if status is not None:
-            doc_ref = doc_ref.where(filter=FieldFilter("status", "==", status))
-        if user_phone is not None:
-            doc_ref = doc_ref.where(filter=FieldFilter("customer", "==", user_phone))
-        ta = TypeAdapter(DatabaseEvent)
-        events = list(
-            map(lambda x: ta.validate_python(x.to_dict(), strict=False), doc_ref.get())
+        events = _unless_calendar_deleted(
+            email,
+            calendarId,
+            lambda: _list_events(
+                email, calendarId, start_date, end_date, status, user_phone
+            ),
+            [],
         )
     return events
 
 
+def get_events_page(
+    email: str,
+    calendarId: str,
+    start_date: Arrow,
+    end_date: Arrow,
+    status: EventStatus | None = None,
+    user_phone: str | None = None,
+    page_size: int | None = None,
+    after: Dict | None = None,
+    fields: List[str] | None = None,
+) -> Tuple[List[DatabaseEvent | Dict], Dict | None]:
+    """
+    Events ordered by startTime then eventId, page_size of them after the cursor. Also
+    returns the cursor of the next page, None when this was the last one.
+
+    With fields only those are downloaded, eventId and startTime always are, and the
+    events come back as dicts instead of being validated.
+    """
+    query = (
+        _events_query(email, calendarId, start_date, end_date, status, user_phone)
+        .order_by("startTime")
+        .order_by(FieldPath.document_id())
+    )
+    if after is not None:
+        query = query.start_after(
+            {"startTime": after["startTime"], "__name__": after["eventId"]}
+        )
+    if page_size is not None:
+        query = query.limit(page_size)
+    if fields is not None:
+        query = query.select(sorted({"eventId", "startTime", *fields}))
+    docs: List[Dict] = _unless_calendar_deleted(
+        email, calendarId, lambda: [z.to_dict() or {} for z in query.get()], []
+    )
+    events: List[DatabaseEvent | Dict] = (
+        list(docs) if fields is not None else [trusted(DatabaseEvent, z) for z in docs]
+    )
+    last = (
+        {"startTime": docs[-1]["startTime"], "eventId": docs[-1]["eventId"]}
+        if page_size is not None and len(docs) == page_size
+        else None
+    )
+    return events, last
+
+
+def get_changed_events(
+    email: str, calendarId: str, since: int, user_phone: str | None = None
+) -> List[DatabaseEvent]:
+    """
+    Events of the calendar written since the given time, whatever their start time and
+    status, so an event moved or cancelled out of a listing reaches the client as well.
+    """
+    query = fsdb.collection(f"{get_doc_path(email, calendarId)}/events").where(
+        filter=FieldFilter("updatedAt", ">", since - sync_overlap_ms)
+    )
+    if user_phone is not None:
+        query = query.where(filter=FieldFilter("customer", "==", user_phone))
+    return _unless_calendar_deleted(
+        email,
+        calendarId,
+        lambda: [trusted(DatabaseEvent, z.to_dict()) for z in query.get()],
+        [],
+    )
+
+
+async def update_and_merge(
+    path: str, update_data: Dict, current: Dict | None = None
+) -> Dict | None:
+    """
+    Updates the document and returns its new state without reading it back afterwards.
+
+    The updated fields are merged over the current state of the document, when the caller
+    doesn't already hold it the read is issued alongside the write instead of after it.
+    Either snapshot (before or after the write) gives the same merge, since the update
+    only replaces top level fields.
+    """
+    ref = fsdb.document(path)
+    if current is None:
+        _, snapshot = await gather(
+            to_thread(ref.update, update_data), to_thread(ref.get)
+        )
+        current = snapshot.to_dict()
+    else:
+        await to_thread(ref.update, update_data)
+    return {**current, **update_data} if current is not None else None
+
+
 def recalibrate_day(incoming_day):
     if not (0 <= incoming_day <= 6):
         raise ValueError("Invalid day: Day must be in the range 0 to 6")
@@ -76,34 +242,49 @@ class FBCalendar:
 
     def create_calendar(self, body: DatabaseCalendar) -> DatabaseCalendar | None:
         fsdb.document(get_doc_path(self.email, body.calendarId)).set(asdict(body))
-        return self.get_calendar(calendarId=body.calendarId)
+        return body
 
     def get_calendar(self, calendarId: str) -> DatabaseCalendar | None:
         data = fsdb.document(get_doc_path(x=self.email, y=calendarId)).get().to_dict()
         return (
-            TypeAdapter(DatabaseCalendar).validate_python(data)
-            if data is not None
+            trusted(DatabaseCalendar, data)
+            if data is not None and not is_deleted(data)
             else None
         )
 
     def get_calendars(self) -> List[DatabaseCalendar]:
         return list(
             map(
-                lambda x: TypeAdapter(DatabaseCalendar).validate_python(x.to_dict()),
-                fsdb.collection(get_doc_path(x=self.email)).get(),
+                lambda x: trusted(DatabaseCalendar, x),
+                filter(
+                    lambda x: not is_deleted(x),
+                    map(
+                        lambda x: x.to_dict(),
+                        fsdb.collection(get_doc_path(x=self.email)).get(),
+                    ),
+                ),
             )
         )
 
-    def update_calendar(
+    async def update_calendar(
         self, calendarId: str, body: UpdateCalendarRequest
     ) -> DatabaseCalendar | None:
-        fsdb.document(get_doc_path(self.email, calendarId)).update(
-            TypeAdapter(UpdateCalendarRequest).dump_python(body, exclude_none=True)
+        data = await update_and_merge(
+            get_doc_path(self.email, calendarId),
+            adapter(UpdateCalendarRequest).dump_python(body, exclude_none=True),
+        )
+        # Written to a calendar being removed the update goes with it. The fields merged
+        # from the request are validated, trusted is only for what firestore holds
+        return (
+            adapter(DatabaseCalendar).validate_python(data)
+            if data is not None and not is_deleted(data)
+            else None
         )
-        return self.get_calendar(calendarId=calendarId)
 
-    def delete_calendar(self, calendarId: str):
-        fsdb.recursive_delete(fsdb.document(get_doc_path(self.email, calendarId)))
+    async def delete_calendar(self, calendarId: str) -> Job:
+        return await start_delete(
+            business=self.email, path=get_doc_path(self.email, calendarId)
+        )
 
     def create_event(
         self,
@@ -113,6 +294,7 @@ class FBCalendar:
         notyf: Notyf,
         description: str | None = None,
         status: EventStatus = EventStatus.tentative,
+        uow: UnitOfWork | None = None,
     ) -> DatabaseEvent | None:
         event = DatabaseEvent(
             calendarId=calendarId,
@@ -124,40 +306,79 @@ class FBCalendar:
             customer=notyf.phoneNumber or "",
             startTime=start_time,
             endTime=end_time,
+            updatedAt=now_ms(),
         )
         event.eventId = generate_id()
+        if uow is not None:
+            # The write is committed later along with the rest of the booking
+            uow.set(
+                get_doc_path(self.email, event.calendarId, event.eventId), asdict(event)
+            )
+            return event
         fsdb.document(get_doc_path(self.email, event.calendarId, event.eventId)).set(
             asdict(event)
         )
-        return self._get_event(calendarId=calendarId, eventId=event.eventId)
+        return event
 
-    def update_event(
-        self, calendarId: str, eventId: str, body: UpdateAppointmentRequest
+    async def update_event(
+        self,
+        calendarId: str,
+        eventId: str,
+        body: UpdateAppointmentRequest,
+        current: DatabaseEvent | None = None,
     ) -> DatabaseEvent | None:
-        fsdb.document(get_doc_path(self.email, calendarId, eventId)).update(
-            TypeAdapter(UpdateAppointmentRequest).dump_python(body, exclude_none=True)
+        return await self._update_event(
+            calendarId,
+            eventId,
+            adapter(UpdateAppointmentRequest).dump_python(body, exclude_none=True),
+            current=current,
         )
-        return self._get_event(calendarId=calendarId, eventId=eventId)
 
-    def update_event_extras(
-        self, calendarId: str, eventId: str, body: UpdateAppointmentRequestExtras
+    async def update_event_extras(
+        self,
+        calendarId: str,
+        eventId: str,
+        body: UpdateAppointmentRequestExtras,
+        current: DatabaseEvent | None = None,
     ) -> DatabaseEvent | None:
-        fsdb.document(get_doc_path(self.email, calendarId, eventId)).update(
-            TypeAdapter(UpdateAppointmentRequestExtras).dump_python(
+        return await self._update_event(
+            calendarId,
+            eventId,
+            adapter(UpdateAppointmentRequestExtras).dump_python(
                 body, exclude_none=True
-            )
+            ),
+            current=current,
+        )
+
+    async def _update_event(
+        self,
+        calendarId: str,
+        eventId: str,
+        update_data: Dict,
+        current: DatabaseEvent | None = None,
+    ) -> DatabaseEvent | None:
+        # An event written under a calendar being removed is swept along with the rest,
+        # the check doesn't have to hold the write back
+        deleted, data = await gather(
+            to_thread(is_calendar_deleted, self.email, calendarId),
+            update_and_merge(
+                get_doc_path(self.email, calendarId, eventId),
+                {**update_data, "updatedAt": now_ms()},
+                current=asdict(current) if current is not None else None,
+            ),
+        )
+        if deleted:
+            return None
+        # Holds fields merged from the request, validated rather than trusted
+        return (
+            adapter(DatabaseEvent).validate_python(data) if data is not None else None
         )
-        return self._get_event(calendarId=calendarId, eventId=eventId)
 
     def _get_event(self, calendarId: str, eventId: str) -> DatabaseEvent | None:
         data = (
             fsdb.document(get_doc_path(self.email, calendarId, eventId)).get().to_dict()
         )
-        return (
-            TypeAdapter(DatabaseEvent).validate_python(data)
-            if data is not None
-            else None
-        )
+        return trusted(DatabaseEvent, data) if data is not None else None
 
     def _get_events(self) -> List[Tuple[DatabaseCalendar, List[DatabaseEvent]]]:
         """
@@ -175,7 +396,8 @@ class FBCalendar:
                         list(
                             filter(
                                 lambda x: x.status != EventStatus.cancelled,
-                                get_events(
+                                # The calendars listed are the ones not deleted
+                                _list_events(
                                     self.email,
                                     c.calendarId,
                                     get(self.output.startDate),
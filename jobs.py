@@ -0,0 +1,254 @@
+from asyncio import gather, to_thread
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import asdict, replace
+from logging import getLogger
+from os import environ
+from time import time
+from typing import Any, List, Set
+
+from google.cloud.firestore_v1.base_query import FieldFilter
+from google.cloud.firestore_v1.field_path import FieldPath
+
+from adapters import trusted
+from common import generate_id
+from database import fsdb
+from model import Job, JobStatus
+
+# Documents removed per batch, the most firestore takes in one
+delete_page_size = 500
+# Batches of a job being committed at the same time
+delete_concurrency = int(environ.get("LOOKAHEAD_DELETE_CONCURRENCY", "4"))
+# A running job renews its lease every time it records progress. Once the lease runs out,
+# the instance running it having stopped or the run having failed, any instance resumes it
+job_lease_secs = 60
+# Runs of a job before it is given up as failed
+job_max_attempts = 5
+
+# Jobs run on their own threads rather than the event loop, they outlive the request that
+# started them and their firestore calls aren't counted against it
+jobs_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="jobs")
+batches_executor = ThreadPoolExecutor(
+    max_workers=delete_concurrency, thread_name_prefix="jobs-batches"
+)
+
+logger = getLogger("lookahead.jobs")
+
+
+def get_job_path(business: str, jobId: str) -> str:
+    return f"businesses/{business}/jobs/{jobId}"
+
+
+def is_deleted(data: Any) -> bool:
+    """
+    Whether the document is being removed by a job, readers should treat it as gone.
+    """
+    return isinstance(data, dict) and data.get("deleted") is True
+
+
+def _is_stale(job: Job) -> bool:
+    return job.status == JobStatus.running and job.leaseUntilUTCSecs < time()
+
+
+class DeleteJob:
+    """
+    Removes a document and everything under it page by page, recording the progress in
+    the job document of the business so any instance can report it, or resume it.
+
+    The document is marked with the id of the job. Writing it again drops the mark, the
+    job then stops and leaves the document be.
+    """
+
+    def __init__(self, job_path: str, job: Job) -> None:
+        self.job_path = job_path
+        self.job = job
+        self.path = job.target
+
+    def save(self, lease: bool = True) -> None:
+        now = int(time())
+        self.job.updateTimeUTCSecs = now
+        self.job.leaseUntilUTCSecs = now + job_lease_secs if lease else 0
+        fsdb.document(self.job_path).set(asdict(self.job))
+
+    def _carries_mark(self, data: Any) -> bool:
+        return is_deleted(data) and data.get("deleteJobId") == self.job.jobId
+
+    def _delete_page(self, page: List[Any]) -> int:
+        batch = fsdb.batch()
+        for z in page:
+            batch.delete(z.reference)
+        batch.commit()
+        return len(page)
+
+    def _delete_collection(self, collection: Any) -> bool:
+        """
+        False when the document lost its mark before the collection was emptied.
+        """
+        query = (
+            collection.select([FieldPath.document_id()])
+            .order_by(FieldPath.document_id())
+            .limit(delete_page_size)
+        )
+        pending: Set[Future] = set()
+
+        def settle(done: Set[Future]) -> None:
+            for z in done:
+                self.job.deleted += z.result()
+            self.save()
+
+        def marked() -> bool:
+            return self._carries_mark(fsdb.document(self.path).get().to_dict())
+
+        page = query.get()
+        while len(page) > 0 and marked():
+            if len(pending) >= delete_concurrency:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                settle(done)
+            pending.add(batches_executor.submit(self._delete_page, page))
+            if len(page) < delete_page_size:
+                break
+            page = query.start_after(page[-1]).get()
+        if len(pending) > 0:
+            done, _ = wait(pending)
+            settle(done)
+        if not marked():
+            return False
+        # Sweeps the subcollections of the removed documents, and whatever was written in
+        # the collection meanwhile
+        self.job.deleted += fsdb.recursive_delete(collection)
+        return True
+
+    def _delete_target(self) -> bool:
+        """
+        Deletes the document itself if it still carries the mark, in a transaction so a
+        write racing it either lands first and keeps it, or after and finds it gone.
+        """
+
+        def run(transaction: Any) -> bool:
+            ref = fsdb.document(self.path)
+            (snapshot,) = transaction.get_all([ref])
+            if not self._carries_mark(snapshot.to_dict()):
+                return False
+            transaction.delete(ref)
+            return True
+
+        return fsdb.run_transaction(run)
+
+    def run(self) -> None:
+        try:
+            ref = fsdb.document(self.path)
+            # Short circuits on the first collection the mark was lost in
+            emptied = all(self._delete_collection(z) for z in ref.collections())
+            if emptied and self._delete_target():
+                self.job.deleted += 1
+                self.job.status = JobStatus.done
+            else:
+                self.job.status = JobStatus.cancelled
+            self.job.error = None
+        except Exception as e:
+            # Left running without a lease for resume_job to retry, pages already removed
+            # aren't found again
+            self.job.error = str(e)
+            if self.job.attempts >= job_max_attempts:
+                self.job.status = JobStatus.failed
+        self.save(lease=False)
+
+
+def _claim(job_path: str) -> Job | None:
+    """
+    Takes over a job whose lease ran out, in a transaction so only one instance does.
+    Returns it with a new lease, or failed once it ran out of attempts, None when it isn't
+    stale anymore.
+    """
+
+    def run(transaction: Any) -> Job | None:
+        ref = fsdb.document(job_path)
+        (snapshot,) = transaction.get_all([ref])
+        data = snapshot.to_dict()
+        if data is None:
+            return None
+        job = trusted(Job, data)
+        if not _is_stale(job):
+            return None
+        now = int(time())
+        if job.attempts >= job_max_attempts:
+            job.status = JobStatus.failed
+        else:
+            job.attempts += 1
+            job.leaseUntilUTCSecs = now + job_lease_secs
+        job.updateTimeUTCSecs = now
+        transaction.set(ref, asdict(job))
+        return job
+
+    return fsdb.run_transaction(run)
+
+
+def resume_job(job_path: str) -> Job | None:
+    """
+    Claims the job when its lease ran out and runs it again in the background. Returns it
+    as claimed, None when it wasn't stale.
+    """
+    job = _claim(job_path)
+    if job is not None and job.status == JobStatus.running:
+        _ = jobs_executor.submit(DeleteJob(job_path, job).run)
+    return job
+
+
+def resume_jobs() -> int:
+    """
+    Resumes the running jobs of every business left without a lease, those of an instance
+    that stopped and those that failed with attempts left. Returns how many were claimed.
+    """
+    query = (
+        fsdb.collection_group("jobs")
+        .where(filter=FieldFilter("status", "==", JobStatus.running))
+        .where(filter=FieldFilter("leaseUntilUTCSecs", "<", int(time())))
+    )
+    try:
+        stale = query.get()
+    except Exception as e:
+        logger.warning(f"Looking up the jobs to resume failed: {e}")
+        return 0
+    claimed = 0
+    for z in stale:
+        try:
+            claimed += resume_job(z.reference.path) is not None
+        except Exception as e:
+            logger.warning(f"Resuming the job {z.reference.path} failed: {e}")
+    return claimed
+
+
+def get_job(business: str, jobId: str) -> Job | None:
+    """
+    The job as last recorded. A job left without a lease is resumed, so following it is
+    enough for it to be retried.
+    """
+    path = get_job_path(business, jobId)
+    data = fsdb.document(path).get().to_dict()
+    if data is None:
+        return None
+    job = trusted(Job, data)
+    if _is_stale(job):
+        claimed = resume_job(path)
+        return claimed if claimed is not None else job
+    return job
+
+
+async def start_delete(business: str, path: str) -> Job:
+    """
+    Marks the document deleted right away and removes it with its subcollections in the
+    background. The returned job can be followed with get_job.
+    """
+    jobId = generate_id()
+    job = DeleteJob(
+        get_job_path(business, jobId),
+        Job(jobId=jobId, kind="delete", target=path, attempts=1),
+    )
+    _ = await gather(
+        to_thread(
+            fsdb.document(path).set, {"deleted": True, "deleteJobId": jobId}, merge=True
+        ),
+        to_thread(job.save),
+    )
+    started = replace(job.job)
+    _ = jobs_executor.submit(job.run)
+    return started
@@ -1,30 +1,53 @@
-from asyncio import create_task, gather
+from asyncio import create_task, gather, to_thread
+from contextlib import asynccontextmanager
 from copy import deepcopy
 from dataclasses import asdict
 from datetime import datetime
 from time import time
-from typing import Annotated, Any, Dict, List
+from typing import Annotated, Any, AsyncIterator, List
 
 from arrow import get
 from fastapi import FastAPI, Header, Request, Response
 from fastapi.exceptions import RequestValidationError, ResponseValidationError
-from fastapi.responses import JSONResponse
-from firebase_admin import auth
+from fastapi.responses import StreamingResponse
 from google.cloud.firestore import Query
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pydantic import TypeAdapter
 from starlette.exceptions import HTTPException
-from starlette.status import __all__
 
-from common import generate_id
-from common2 import find_subject
+from adapters import adapter, trusted
+from auth_cache import get_token_cache_stats
+from client_index import get_index, invalidate, put_client, remove_client
+from clients import (
+    get_clients_page,
+    get_lastLogin,
+    import_clients,
+    iter_clients,
+    parse_import_rows,
+    with_lastLogin,
+)
+from common import decode_cursor, encode_cursor, generate_id
+from common2 import find_subject, get_business_coalesced
 from constants import date_format, date_format2
 from database import fsdb
 from embed import handle_create_appointment, handle_search
 from embed import router as embed_router
-from fbcalendar import FBCalendar, get_events
+from errors import error_messages
+from fbcalendar import (
+    FBCalendar,
+    calendars_flight,
+    events_flight,
+    get_changed_events,
+    get_events,
+    get_events_page,
+    max_events_page_size,
+    now_ms,
+)
+from jobs import get_job, is_deleted, resume_jobs, start_delete
 from model import (
+    Business,
     CalendarResponse,
+    ClientImportResponse,
+    ClientImportStatus,
     ClientModel,
     ClientModelResponse,
     ClientsModelResponse,
@@ -34,8 +57,10 @@ from model import (
     EventResponse,
     EventStatus,
     FcmResultResponse,
+    FirestoreMetricsResponse,
     GetAppointmentsResponse,
     GetCalendarsResponse,
+    JobResponse,
     MessagingRequest,
     MinimalClientModel,
     SearchAppointmentRequest,
@@ -44,17 +69,23 @@ from model import (
     SendNotyf,
     SetAppointmentRequest,
     SetAppointmentResponse,
+    SingleFlightMetricsResponse,
     Subject,
     Todo,
     TodoBase,
     TodoBaseUpdate,
     TodoListResponse,
     TodoResponse,
+    TokenCacheMetricsResponse,
     UpdatableClientModel,
     UpdateAppointmentRequestExtras,
     UpdateCalendarRequest,
 )
+from middleware import AuthMiddleware, add_cors_headers
 from notyf import Notyf
+from opstats import get_route_stats
+from responses import NegotiatedResponse
+from singleflight import get_flight_stats
 from um import router as um_router
 from utils import cross_sync_business_and_client
 
@@ -65,12 +96,7 @@ app = FastAPI(
 
 embed = "/embed"
 
-
-def add_cors_headers(response: Response) -> Response:
-    response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Methods"] = "GET, POST, PUT, DELETE, OPTIONS"
-    response.headers["Access-Control-Allow-Headers"] = "*"
-    return response
+event_fields = set(DatabaseEvent.__dataclass_fields__)
 
 
 async def catch_all(
@@ -78,57 +104,82 @@ async def catch_all(
     e: HTTPException | RequestValidationError | ResponseValidationError | Any,
 ) -> Response:
     resp = CommonResponse()
-    if type(e) == HTTPException:
+    if isinstance(e, HTTPException):
         resp.message = e.detail
-    elif type(e) == RequestValidationError or type(e) == ResponseValidationError:
-        resp.message = TypeAdapter(List[Dict]).validate_python(eval(str(e)))
-    return add_cors_headers(JSONResponse(content=asdict(resp)))
+        return NegotiatedResponse(content=resp)
+    if isinstance(e, RequestValidationError):
+        resp.message = error_messages(e.errors())
+        return NegotiatedResponse(content=resp)
+    if isinstance(e, ResponseValidationError):
+        resp.message = error_messages(e.errors())
+    # Server errors are answered outside the middleware, the CORS headers are added here
+    return add_cors_headers(NegotiatedResponse(content=resp))
+
 
+exception_handlers = {
+    HTTPException: catch_all,
+    RequestValidationError: catch_all,
+    500: catch_all,
+}
 
+
+@asynccontextmanager
+async def lifespan(_: FastAPI) -> AsyncIterator[None]:
+    # Jobs left running by an instance that stopped carry on here
+    _ = await to_thread(resume_jobs)
+    yield
+
+
+# orjson serializes the dataclasses and enums itself, much faster than the json module,
+# MessagePack is used instead for the clients asking for it
 app = FastAPI(
-    exception_handlers={
-        key: catch_all
-        for key in list(
-            filter(lambda y: y != 200, map(lambda x: int(x.split("_")[1]), __all__))
-        )
-    }
+    default_response_class=NegotiatedResponse,
+    exception_handlers=exception_handlers,
+    lifespan=lifespan,
 )
 
 
-@app.middleware("http")
-async def auth_mw(request: Request, call_next):
+app.add_middleware(AuthMiddleware, public_prefix=embed)
+
+
+def only_business_accounts(request: Request) -> None:
     """
-    This function is a middleware for the fast api application.
-    It verifies the accesskey in the header and if it is valid then it adds the decoded token to the request state.
+    The metrics cover every business, they are served to business and staff accounts,
+    whose tokens carry an email, never to the customers signed in with a phone.
     """
-    if request.url.path in ["/docs", "/openapi.json"] or request.url.path.startswith(
-        embed
-    ):
-        response = await call_next(request)
-        return add_cors_headers(response=response)
-    accesskey = request.headers.get("accesskey")
-    if accesskey is not None:
-        try:
-            decoded_token = auth.verify_id_token(accesskey)
-            request.state.decoded_token = decoded_token
-            response = await call_next(request)
-            return add_cors_headers(response=response)
-        except Exception as e:
-            return add_cors_headers(
-                response=JSONResponse(
-                    content=asdict(CommonResponse(message="Error: " + str(e)))
-                )
-            )
-    else:
-        return add_cors_headers(
-            JSONResponse(
-                content=asdict(
-                    CommonResponse(message="Auth error, double check your token!")
-                )
-            )
+    if request.state.decoded_token.get("email") is None:
+        raise HTTPException(
+            status_code=403, detail="Metrics are only served to business accounts"
         )
 
 
+@app.get("/metrics/firestore")
+async def firestore_metrics(
+    request: Request, accesskey: Annotated[str | None, Header()]
+) -> FirestoreMetricsResponse:
+    only_business_accounts(request)
+    return FirestoreMetricsResponse(
+        success=True,
+        routes=sorted(get_route_stats(), key=lambda z: z.ms, reverse=True),
+    )
+
+
+@app.get("/metrics/singleflight")
+async def singleflight_metrics(
+    request: Request, accesskey: Annotated[str | None, Header()]
+) -> SingleFlightMetricsResponse:
+    only_business_accounts(request)
+    return SingleFlightMetricsResponse(success=True, flights=get_flight_stats())
+
+
+@app.get("/metrics/tokens")
+async def token_metrics(
+    request: Request, accesskey: Annotated[str | None, Header()]
+) -> TokenCacheMetricsResponse:
+    only_business_accounts(request)
+    return TokenCacheMetricsResponse(success=True, tokens=get_token_cache_stats())
+
+
 @app.post("/calendars")
 async def create_calendar(
     request: Request, accesskey: Annotated[str | None, Header()], body: DatabaseCalendar
@@ -151,7 +202,9 @@ async def get_calendars(
     subject = await find_subject(request=request)
     return GetCalendarsResponse(
         success=True,
-        items=FBCalendar(subject.business, None).get_calendars()
+        items=await calendars_flight.do(
+            subject.business, FBCalendar(subject.business, None).get_calendars
+        )
         if subject.business is not None
         else [],
     )
@@ -168,7 +221,7 @@ async def update_calendar(
     if body.timeZone is not None:
         _ = get(0, tzinfo=body.timeZone)
     calendar = (
-        FBCalendar(subject.business, None).update_calendar(
+        await FBCalendar(subject.business, None).update_calendar(
             calendarId=calendarId, body=body
         )
         if subject.business is not None
@@ -180,13 +233,18 @@ async def update_calendar(
 @app.delete("/calendars/{calendarId}")
 async def delete_calendar(
     request: Request, accesskey: Annotated[str | None, Header()], calendarId: str
-) -> CommonResponse:
+) -> JobResponse:
+    """
+    The calendar is gone from the api right away, its events are removed by a background
+    job, follow it with GET /jobs/{jobId}.
+    """
     subject = await find_subject(request=request)
-    return CommonResponse(
-        success=(FBCalendar(subject.business, None).delete_calendar(calendarId) is None)
-        if subject.business is not None
-        else False
-    )
+    if subject.business is not None:
+        return JobResponse(
+            success=True,
+            job=await FBCalendar(subject.business, None).delete_calendar(calendarId),
+        )
+    return JobResponse(success=False)
 
 
 @app.get("/calendars/{calendarId}/appointments")
@@ -198,7 +256,21 @@ async def get_appointments(
     endDate: datetime | str | int,
     status: EventStatus | None = None,
     email: str | None = None,
+    pageSize: int | None = None,
+    cursor: str | None = None,
+    fields: str | None = None,
+    syncToken: str | None = None,
 ) -> GetAppointmentsResponse:
+    """
+    Appointments starting in the range. With pageSize they come ordered by startTime a
+    page at a time, pass the nextCursor of a response as the cursor to get the next one.
+    fields is a comma separated list of the event fields to return, eventId and startTime
+    are always included.
+
+    Unpaged responses carry a syncToken. Passing it back returns only the events created
+    or changed since, cancelled ones included, whatever their start time and status, along
+    with the token for the next poll. Merge them by eventId, an event can come twice.
+    """
     subject = await find_subject(request=request)
 
     if subject.business is None:
@@ -219,16 +291,97 @@ async def get_appointments(
         _cast(endDate) if isinstance(endDate, str) and _cast(endDate) != 0 else endDate
     )
 
+    if subject.business is not None and syncToken is not None:
+        business, phone = subject.business, subject.phone
+        since = decode_cursor(syncToken, updatedAt=int)["updatedAt"]
+        token, changed = await events_flight.do(
+            ("changed", business, calendarId, since, phone),
+            lambda: (
+                now_ms(),
+                get_changed_events(
+                    email=business, calendarId=calendarId, since=since, user_phone=phone
+                ),
+            ),
+        )
+        return GetAppointmentsResponse(
+            success=True,
+            items=changed,
+            syncToken=encode_cursor({"updatedAt": token}),
+        )
+
+    if subject.business is not None and (
+        pageSize is not None or cursor is not None or fields is not None
+    ):
+        business, phone = subject.business, subject.phone
+        start, end = get(startDate), get(endDate)
+        page_size = (
+            min(max(pageSize, 1), max_events_page_size)
+            if pageSize is not None
+            else None
+        )
+        after = (
+            decode_cursor(cursor, startTime=int, eventId=str)
+            if cursor is not None
+            else None
+        )
+        projection = (
+            sorted({z.strip() for z in fields.split(",")} & event_fields)
+            if fields is not None
+            else None
+        )
+        _t, last = await events_flight.do(
+            (
+                business,
+                calendarId,
+                start.timestamp(),
+                end.timestamp(),
+                status,
+                phone,
+                page_size,
+                cursor,
+                tuple(projection) if projection is not None else None,
+            ),
+            lambda: get_events_page(
+                email=business,
+                calendarId=calendarId,
+                start_date=start,
+                end_date=end,
+                status=status,
+                user_phone=phone,
+                page_size=page_size,
+                after=after,
+                fields=projection,
+            ),
+        )
+        return GetAppointmentsResponse(
+            success=len(_t) > 0,
+            items=_t,
+            nextCursor=encode_cursor(last) if last is not None else None,
+        )
+
     if subject.business is not None:
-        events: List[DatabaseEvent] = get_events(
-            email=subject.business,
-            calendarId=calendarId,
-            start_date=get(startDate),
-            end_date=get(endDate),
-            status=status,
-            user_phone=subject.phone,
+        business, phone = subject.business, subject.phone
+        start, end = get(startDate), get(endDate)
+        # The token is taken before the read, a change racing it comes in the next delta
+        token, events = await events_flight.do(
+            (business, calendarId, start.timestamp(), end.timestamp(), status, phone),
+            lambda: (
+                now_ms(),
+                get_events(
+                    email=business,
+                    calendarId=calendarId,
+                    start_date=start,
+                    end_date=end,
+                    status=status,
+                    user_phone=phone,
+                ),
+            ),
+        )
+        return GetAppointmentsResponse(
+            success=len(events) > 0,
+            items=events,
+            syncToken=encode_cursor({"updatedAt": token}),
         )
-        return GetAppointmentsResponse(success=len(events) > 0, items=events)
     return GetAppointmentsResponse(items=[])
 
 
@@ -238,7 +391,7 @@ async def search(
     accesskey: Annotated[str | None, Header()],
     body: SearchAppointmentRequest,
 ) -> SearchAppointmentResponse:
-    subject = await find_subject(request=request)
+    subject = await find_subject(request=request, body=body)
     return await handle_search(body=body, subject=subject)
 
 
@@ -248,7 +401,7 @@ async def create_appointment(
     accesskey: Annotated[str | None, Header()],
     body: SetAppointmentRequest,
 ) -> SetAppointmentResponse:
-    subject = await find_subject(request=request)
+    subject = await find_subject(request=request, body=body)
     return await handle_create_appointment(body=body, subject=subject)
 
 
@@ -260,10 +413,10 @@ async def update_appointment(
     eventId: str,
     body: UpdateAppointmentRequestExtras,
 ) -> EventResponse:
-    subject = await find_subject(request=request)
+    subject = await find_subject(request=request, body=body)
     if subject.business is not None:
         fbc = FBCalendar(subject.business, None)
-        event = fbc.update_event(calendarId, eventId, body=body)
+        event = await fbc.update_event(calendarId, eventId, body=body)
         if event is not None:
             update_data = {}
 
@@ -289,10 +442,10 @@ async def update_appointment(
                 Study create appointment source code
                 """
                 event.customer = body.customer
-                cross_sync_business_and_client(
+                await cross_sync_business_and_client(
                     business=subject.business, user_phone=event.customer
                 )
-                _event = fbc.update_event_extras(
+                _event = await fbc.update_event_extras(
                     calendarId,
                     eventId,
                     body=UpdateAppointmentRequestExtras(
@@ -300,6 +453,7 @@ async def update_appointment(
                         customer=event.customer,
                         description=body.description,
                     ),
+                    current=event,
                 )
                 if _event is not None:
                     c = fbc.get_calendar(calendarId=_event.calendarId)
@@ -324,28 +478,33 @@ async def update_appointment(
 
 async def get_client_and_lastLogin(
     business: str, user_phone: str, cm: ClientModel | None = None
-) -> ClientModel:
+) -> ClientModel | None:
+    """
+    None when the client doesn't exist, or is being deleted.
+    """
+
     async def step1():
         nonlocal cm
         if cm is None:
-            cm = TypeAdapter(ClientModel).validate_python(
+            data = (
                 fsdb.document(f"businesses/{business}/clients/{user_phone}")
                 .get()
                 .to_dict()
             )
+            if data is not None and not is_deleted(data):
+                cm = trusted(ClientModel, data)
 
     lastLogin: str | None = None
 
     async def step2():
         nonlocal lastLogin
-        _t1 = fsdb.document(f"users/{user_phone}").get().to_dict()
-        if _t1 is not None:
-            lastLogin = _t1.get("last_login")
+        lastLogin = get_lastLogin(fsdb.document(f"users/{user_phone}").get().to_dict())
 
     tasks = [create_task(step1()), create_task(step2())]
     _ = await gather(*tasks)
 
-    assert cm is not None
+    if cm is None:
+        return None
 
     if lastLogin is not None:
         cm.lastLogin = lastLogin
@@ -372,15 +531,15 @@ async def create_client(
 ) -> ClientModelResponse | None:
     subject = await find_subject(request=request)
     if subject.business is not None:
-        cross_sync_business_and_client(
+        await cross_sync_business_and_client(
             business=subject.business, user_phone=body.phone, mcm=body
         )
-        return ClientModelResponse(
-            success=True,
-            client=await get_client_and_lastLogin(
-                business=subject.business, user_phone=body.phone
-            ),
+        cm = await get_client_and_lastLogin(
+            business=subject.business, user_phone=body.phone
         )
+        if cm is not None:
+            put_client(business=subject.business, cm=cm)
+        return ClientModelResponse(success=cm is not None, client=cm)
     return None
 
 
@@ -394,13 +553,101 @@ async def update_client(
     subject = await find_subject(request=request)
     if subject.business is not None:
         doc_path = f"businesses/{subject.business}/clients/{client_phone}"
-        fsdb.document(doc_path).update(
-            TypeAdapter(UpdatableClientModel).dump_python(body, exclude_none=True)
+        update_data = adapter(UpdatableClientModel).dump_python(body, exclude_none=True)
+
+        # A client being deleted isn't updated, the check and the write are one transaction
+        def run(transaction: Any) -> bool:
+            ref = fsdb.document(doc_path)
+            (snapshot,) = transaction.get_all([ref])
+            if not snapshot.exists or is_deleted(snapshot.to_dict()):
+                return False
+            transaction.update(ref, update_data)
+            return True
+
+        if not await to_thread(fsdb.run_transaction, run):
+            return ClientModelResponse(success=False, message="Client not found")
+        cm = await get_client_and_lastLogin(
+            business=subject.business, user_phone=client_phone
+        )
+        if cm is not None:
+            put_client(business=subject.business, cm=cm)
+        return ClientModelResponse(success=cm is not None, client=cm)
+    return None
+
+
+@app.get("/clientManagement/export")
+async def export_clients(
+    request: Request, accesskey: Annotated[str | None, Header()]
+) -> StreamingResponse:
+    """
+    Every client of the business as newline delimited JSON, streamed in chunks.
+    """
+    subject = await find_subject(request=request)
+
+    async def ndjson():
+        if subject.business is not None:
+            async for chunk in iter_clients(business=subject.business):
+                for cm in chunk:
+                    if cm.phone != "+10000000000":
+                        yield adapter(ClientModel).dump_json(cm) + b"\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.post("/clientManagement/import")
+async def bulk_import_clients(
+    request: Request, accesskey: Annotated[str | None, Header()]
+) -> ClientImportResponse:
+    """
+    Creates or updates clients in bulk. The body is MinimalClientModel rows, as CSV with a
+    header row when the Content-Type is text/csv and as newline delimited JSON otherwise.
+    Rows are validated and written as the body streams in, every row gets a result.
+    """
+    subject = await find_subject(request=request)
+    if subject.business is None:
+        return ClientImportResponse(success=False)
+    bzz = await get_business_coalesced(businessEmail=subject.business)
+    if bzz is None:
+        bzz = Business(
+            docID=subject.business, email=subject.business, business=subject.business
         )
-        return ClientModelResponse(
+    is_csv = request.headers.get("content-type", "").startswith("text/csv")
+    results = await import_clients(
+        bzz=bzz, rows=parse_import_rows(request.stream(), is_csv=is_csv)
+    )
+    invalidate(business=subject.business)
+    counts = {z: 0 for z in ClientImportStatus}
+    for z in results:
+        counts[z.status] += 1
+    return ClientImportResponse(
+        success=counts[ClientImportStatus.failed] == 0,
+        created=counts[ClientImportStatus.created],
+        updated=counts[ClientImportStatus.updated],
+        invalid=counts[ClientImportStatus.invalid],
+        failed=counts[ClientImportStatus.failed],
+        results=results,
+    )
+
+
+@app.get("/clientManagement/search")
+async def search_clients(
+    request: Request,
+    accesskey: Annotated[str | None, Header()],
+    q: str,
+    limit: int = 20,
+) -> ClientsModelResponse | None:
+    """
+    Clients with a name, email or group word starting with every word of q, or a phone
+    number starting with its digits, ordered by name.
+    """
+    limit = min(max(limit, 1), 100)
+    subject = await find_subject(request=request)
+    if subject.business is not None:
+        index = await get_index(business=subject.business)
+        return ClientsModelResponse(
             success=True,
-            client=await get_client_and_lastLogin(
-                business=subject.business, user_phone=client_phone
+            clients=await with_lastLogin(
+                [deepcopy(z) for z in index.search(q=q, limit=limit)]
             ),
         )
     return None
@@ -412,58 +659,78 @@ async def get_client(
 ) -> ClientModelResponse | None:
     subject = await find_subject(request=request)
     if subject.business is not None:
-        return ClientModelResponse(
-            success=True,
-            client=await get_client_and_lastLogin(
-                business=subject.business, user_phone=client_phone
-            ),
+        cm = await get_client_and_lastLogin(
+            business=subject.business, user_phone=client_phone
         )
+        return ClientModelResponse(success=cm is not None, client=cm)
     return None
 
 
 @app.get("/clientManagement")
 async def get_clients(
-    request: Request, accesskey: Annotated[str | None, Header()], limit: int = 100
+    request: Request,
+    accesskey: Annotated[str | None, Header()],
+    limit: int = 100,
+    cursor: str | None = None,
 ) -> ClientsModelResponse | None:
-    if limit > 100:
-        limit = 100
+    """
+    Clients ordered by phone, a page at a time. Pass the nextCursor of a response as the
+    cursor to get the next page, nextCursor is null on the last page.
+    """
+    limit = min(max(limit, 1), 100)
     subject = await find_subject(request=request)
     if subject.business is not None:
-        col_path = f"businesses/{subject.business}/clients"
-        _t1 = fsdb.collection(col_path).limit(limit).get()
-        tasks = []
-        for z in _t1:
-            cm = TypeAdapter(ClientModel).validate_python(z.to_dict())
-            tasks.append(
-                create_task(
-                    get_client_and_lastLogin(
-                        business=subject.business, user_phone=cm.phone, cm=cm
-                    )
-                )
-            )
-        _t2: List[ClientModel] = await gather(*tasks)
-        clients = list(
-            sorted(
-                list(filter(lambda z: z.phone != "+10000000000", _t2)),
-                key=lambda z: z.phone,
-            )
+        after = (
+            decode_cursor(cursor, phone=str)["phone"] if cursor is not None else None
+        )
+        _t1, last = get_clients_page(
+            business=subject.business, limit=limit, after=after
+        )
+        _t2 = await with_lastLogin(_t1)
+        clients = list(filter(lambda z: z.phone != "+10000000000", _t2))
+        return ClientsModelResponse(
+            success=True,
+            clients=clients,
+            nextCursor=encode_cursor({"phone": last}) if last is not None else None,
         )
-        return ClientsModelResponse(success=True, clients=clients)
     return None
 
 
 @app.delete("/clientManagement/{client_phone}")
 async def delete_client(
     request: Request, accesskey: Annotated[str | None, Header()], client_phone: str
-) -> CommonResponse:
+) -> JobResponse:
+    """
+    The client is gone from the api right away, its message history is removed by a
+    background job, follow it with GET /jobs/{jobId}.
+    """
     subject = await find_subject(request=request)
     if subject.business is not None:
         doc_path = f"businesses/{subject.business}/clients/{client_phone}"
-        doc_ref = fsdb.document(doc_path)
-        fsdb.recursive_delete(doc_ref)
-        fsdb.document(f"users/{client_phone}/businesses/{subject.business}").delete()
-        return CommonResponse(success=True)
-    return CommonResponse(success=False)
+        job, _ = await gather(
+            start_delete(business=subject.business, path=doc_path),
+            to_thread(
+                fsdb.document(
+                    f"users/{client_phone}/businesses/{subject.business}"
+                ).delete
+            ),
+        )
+        remove_client(business=subject.business, phone=client_phone)
+        return JobResponse(success=True, job=job)
+    return JobResponse(success=False)
+
+
+@app.get("/jobs/{jobId}")
+async def get_job_status(
+    request: Request, accesskey: Annotated[str | None, Header()], jobId: str
+) -> JobResponse:
+    subject = await find_subject(request=request)
+    job = (
+        await to_thread(get_job, subject.business, jobId)
+        if subject.business is not None
+        else None
+    )
+    return JobResponse(success=job is not None, job=job)
 
 
 @app.post("/messaging")
@@ -474,13 +741,19 @@ async def create_messaging(
     if subject.business is not None:
         send_everyone = False
 
+        def client_phones(query: Any) -> List[str]:
+            # The id is the phone, only the deleted mark is downloaded to skip the clients
+            # being deleted
+            return [
+                z.id
+                for z in query.select(["deleted"]).get()
+                if not is_deleted(z.to_dict())
+            ]
+
         def get_phone_numbers_by_group(group: str) -> List[str]:
-            return list(
-                map(
-                    lambda x: x.id,
-                    fsdb.collection(f"businesses/{subject.business}/clients")
-                    .where(filter=FieldFilter("group", "==", group))
-                    .get(),
+            return client_phones(
+                fsdb.collection(f"businesses/{subject.business}/clients").where(
+                    filter=FieldFilter("group", "==", group)
                 )
             )
 
@@ -493,13 +766,9 @@ async def create_messaging(
             phone_numbers.extend(get_phone_numbers_by_group(x))
 
         if send_everyone is True:
-            phone_numbers = []
-            for z in (
-                fsdb.collection(f"businesses/{subject.business}/clients")
-                .limit(1000)
-                .get()
-            ):
-                phone_numbers.append(z.id)
+            phone_numbers = client_phones(
+                fsdb.collection(f"businesses/{subject.business}/clients").limit(1000)
+            )
 
         phone_numbers = list(sorted(list(set(phone_numbers))))
 
@@ -555,7 +824,7 @@ async def todo_create(
         _t2 = get(int(time())).to("+00:00")
         if subject.phone in body.collaborators:
             body.collaborators.remove(subject.phone)
-        _t1 = TypeAdapter(Todo).validate_python(
+        _t1 = adapter(Todo).validate_python(
             Todo(
                 todoID=generate_id(),
                 creator=subject.phone,
@@ -592,7 +861,7 @@ async def todo_read_all(
 
         _t1 = list(
             map(
-                lambda z: TypeAdapter(Todo).validate_python(z.to_dict()),
+                lambda z: trusted(Todo, z.to_dict()),
                 created_ones + collab_ones,
             )
         )
@@ -615,7 +884,7 @@ async def todo_update(
     if subject.phone is not None:
         doc_ref = f"ToDos/{todoID}"
         _t2 = fsdb.document(doc_ref).get().to_dict()
-        _t3 = TypeAdapter(Todo).validate_python(_t2) if _t2 is not None else None
+        _t3 = trusted(Todo, _t2) if _t2 is not None else None
         if _t3 is not None and (
             _t3.creator == subject.phone or subject.phone in _t3.collaborators
         ):
@@ -625,16 +894,14 @@ async def todo_update(
                 body.collaborators = list(set(body.collaborators))
             fsdb.document(doc_ref).update(
                 {
-                    **TypeAdapter(TodoBaseUpdate).dump_python(body, exclude_none=True),
+                    **adapter(TodoBaseUpdate).dump_python(body, exclude_none=True),
                     **{"updatedUTCMins": int(time())},
                 }
             )
             _t1 = fsdb.document(doc_ref).get().to_dict()
             return TodoResponse(
                 success=True,
-                result=todo_format(TypeAdapter(Todo).validate_python(_t1))
-                if _t1 is not None
-                else None,
+                result=todo_format(trusted(Todo, _t1)) if _t1 is not None else None,
             )
     return TodoResponse(success=False)
 
@@ -647,7 +914,7 @@ async def todo_delete(
     if subject.phone is not None:
         doc_ref = f"ToDos/{todoID}"
         _t2 = fsdb.document(doc_ref).get().to_dict()
-        _t3 = TypeAdapter(Todo).validate_python(_t2) if _t2 is not None else None
+        _t3 = trusted(Todo, _t2) if _t2 is not None else None
         if _t3 is not None and (
             _t3.creator == subject.phone or subject.phone in _t3.collaborators
         ):
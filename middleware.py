@@ -0,0 +1,243 @@
+from typing import Iterable, Iterator, List, Tuple
+
+from msgpack import unpackb
+from orjson import JSONEncodeError, dumps
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from auth_cache import verify_token
+from model import CommonResponse
+from opstats import aggregate, start_request, stats_headers
+from responses import NegotiatedResponse, msgpack_types, wants_msgpack
+
+firestore_headers = [
+    "X-Firestore-Reads",
+    "X-Firestore-Writes",
+    "X-Firestore-Deletes",
+    "X-Firestore-Calls",
+    "X-Firestore-Ms",
+]
+
+# Built once, appended as is to every response
+cors_headers: List[Tuple[bytes, bytes]] = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"GET, POST, PUT, DELETE, OPTIONS"),
+    (b"access-control-allow-headers", b"*"),
+    (b"access-control-expose-headers", ", ".join(firestore_headers).encode()),
+]
+
+preflight_headers: List[Tuple[bytes, bytes]] = [
+    *cors_headers,
+    (b"access-control-max-age", b"86400"),
+    (b"content-length", b"0"),
+]
+
+
+def add_cors_headers(response: Response) -> Response:
+    response.raw_headers.extend(cors_headers)
+    return response
+
+
+def _header(scope: Scope, name: bytes) -> bytes | None:
+    for k, v in scope["headers"]:
+        if k == name:
+            return v
+    return None
+
+
+class InvalidBody(ValueError):
+    """
+    A msgpack request body that can't be passed on as JSON, answered with a 400.
+    """
+
+
+def _media_ranges(value: bytes) -> Iterator[Tuple[bytes, float]]:
+    """
+    The media ranges of an Accept header with their quality, 1 when not given.
+    """
+    for z in value.split(b","):
+        media, *params = (x.strip() for x in z.split(b";"))
+        q = 1.0
+        for p in params:
+            k, _, v = p.partition(b"=")
+            if k.strip().lower() == b"q":
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        if media != b"":
+            yield media.lower(), q
+
+
+def _accepts_msgpack(accept: bytes | None) -> bool:
+    """
+    Whether msgpack is named with a quality above 0 and at least that of JSON, which
+    the wildcards stay on.
+    """
+    if accept is None:
+        return False
+    ranges = dict(_media_ranges(accept))
+    msgpack_q = max((ranges.get(z, 0.0) for z in msgpack_types), default=0.0)
+    json_q = next(
+        (
+            ranges[z]
+            for z in (b"application/json", b"application/*", b"*/*")
+            if z in ranges
+        ),
+        0.0,
+    )
+    return msgpack_q > 0 and msgpack_q >= json_q
+
+
+def _is_msgpack(content_type: bytes | None) -> bool:
+    return (
+        content_type is not None
+        and content_type.split(b";", 1)[0].strip().lower() in msgpack_types
+    )
+
+
+async def _json_body(scope: Scope, receive: Receive) -> Receive:
+    """
+    Reads a msgpack request body and passes it on as JSON, so the endpoints and their
+    validation see what a JSON client would have sent. Raises InvalidBody when it is
+    empty, malformed or holds types JSON doesn't have, like bin.
+    """
+    chunks: List[bytes] = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            break
+    packed = b"".join(chunks)
+    if packed == b"":
+        raise InvalidBody("Empty msgpack body")
+    try:
+        unpacked = unpackb(packed)
+    except Exception as e:
+        raise InvalidBody(f"Invalid msgpack body: {e}") from e
+    try:
+        body = dumps(unpacked)
+    except JSONEncodeError as e:
+        raise InvalidBody(
+            f"The msgpack body holds a value JSON has no type for: {e}"
+        ) from e
+    scope["headers"] = [
+        *(
+            (k, v)
+            for k, v in scope["headers"]
+            if k not in (b"content-type", b"content-length")
+        ),
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    sent = False
+
+    async def receive_json() -> Message:
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return receive_json
+
+
+class AuthMiddleware:
+    """
+    Verifies the accesskey header and puts the decoded token in the request state, then
+    adds the CORS and X-Firestore-* headers to the response. Preflight requests are
+    answered here, they never reach the app.
+
+    Errors raised by a handler before it responds come back as a CommonResponse, like the
+    auth errors.
+
+    Clients accepting application/msgpack get their responses in MessagePack, and may
+    send their bodies in it with that content type.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        public_paths: Iterable[str] = ("/docs", "/openapi.json"),
+        public_prefix: str = "/embed",
+    ) -> None:
+        self.app = app
+        self.public_paths = frozenset(public_paths)
+        self.public_prefix = public_prefix
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if (
+            scope["method"] == "OPTIONS"
+            and _header(scope, b"access-control-request-method") is not None
+        ):
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": 204,
+                    "headers": preflight_headers,
+                }
+            )
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        stats = start_request()
+        started = False
+        negotiated = wants_msgpack.set(_accepts_msgpack(_header(scope, b"accept")))
+
+        async def send_with_headers(message: Message) -> None:
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+                headers = [*message.get("headers", ()), *cors_headers]
+                headers.append((b"vary", b"accept"))
+                # A streamed body does its reads after the headers are sent, its counts
+                # would be wrong, they only go to the route aggregate
+                if any(k == b"content-length" for k, _ in headers):
+                    headers.extend(
+                        (k.encode(), v.encode())
+                        for k, v in stats_headers(stats).items()
+                    )
+                message["headers"] = headers
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                route = scope.get("route")
+                if route is not None:
+                    aggregate(f"{scope['method']} {route.path}", stats)
+            await send(message)
+
+        path: str = scope["path"]
+        public = path in self.public_paths or path.startswith(self.public_prefix)
+        try:
+            if not public:
+                accesskey = _header(scope, b"accesskey")
+                if accesskey is None:
+                    await NegotiatedResponse(
+                        content=CommonResponse(
+                            message="Auth error, double check your token!"
+                        )
+                    )(scope, receive, send_with_headers)
+                    return
+                decoded_token = await verify_token(accesskey.decode("latin-1"))
+                scope.setdefault("state", {})["decoded_token"] = decoded_token
+            if _is_msgpack(_header(scope, b"content-type")):
+                receive = await _json_body(scope, receive)
+            await self.app(scope, receive, send_with_headers)
+        except InvalidBody as e:
+            await NegotiatedResponse(
+                status_code=400, content=CommonResponse(message=str(e))
+            )(scope, receive, send_with_headers)
+        except Exception as e:
+            if started or public:
+                raise
+            await NegotiatedResponse(
+                content=CommonResponse(message="Error: " + str(e))
+            )(scope, receive, send_with_headers)
+        finally:
+            wants_msgpack.reset(negotiated)
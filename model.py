@@ -2,10 +2,9 @@ from dataclasses import dataclass, field
 from datetime import datetime
 from enum import StrEnum
 from time import time
-from typing import Annotated, Dict, List, Optional
+from typing import Annotated, Any, Dict, List, Optional
 
-from phonenumbers import is_valid_number, parse
-from pydantic import EmailStr
+from pydantic import EmailStr, Field
 from pydantic.dataclasses import dataclass as pydantic_dataclass
 
 from common import generate_id
@@ -83,7 +82,8 @@ class EventStatus(StrEnum):
     cancelled = "cancelled"
 
 
-@dataclass
+# Slotted like the other models listed or searched by the thousand, no per instance dict
+@dataclass(slots=True)
 class DatabaseEvent:
     calendarId: str
     summary: str
@@ -93,22 +93,25 @@ class DatabaseEvent:
     startTime: int
     endTime: int
     eventId: str = field(default_factory=generate_id)
+    # Milliseconds since the epoch of the last write, for delta syncs. Stamped when the
+    # event is written, None on events written before it was tracked
+    updatedAt: int | None = field(default=None)
 
 
-@dataclass
+@dataclass(slots=True)
 class Event:
     eventId: str
     startTime: int
     endTime: int
 
 
-@dataclass
+@dataclass(slots=True)
 class Slot:
     startTime: int
     endTime: int
 
 
-@dataclass
+@dataclass(slots=True)
 class SlotHolder:
     calendarId: str
     calendarName: str
@@ -148,7 +151,12 @@ class UpdateCalendarRequest:
 
 @dataclass
 class GetAppointmentsResponse(CommonResponse):
-    items: List[DatabaseEvent]
+    # Plain dicts when only some fields were asked for
+    items: List[
+        Annotated[DatabaseEvent | Dict[str, Any], Field(union_mode="left_to_right")]
+    ]
+    nextCursor: str | None = None
+    syncToken: str | None = None
 
 
 @dataclass(kw_only=True)
@@ -192,6 +200,8 @@ class UpdateAppointmentRequest:
 
 def validate_phone_number(value: Optional[str]) -> Optional[str]:
     if value is not None:
+        from phonenumbers import is_valid_number, parse
+
         _t = parse(value)
         if is_valid_number(_t) is False:
             return None
@@ -219,19 +229,19 @@ class FcmResultResponse(CommonResponse):
     result: List[FcmResult]
 
 
-@pydantic_dataclass
+@pydantic_dataclass(slots=True)
 class UpdatableClientModel:
     name: str | None = None
     email: str | None = None
     group: str | None = None
 
 
-@pydantic_dataclass(kw_only=True)
+@pydantic_dataclass(kw_only=True, slots=True)
 class MinimalClientModel(UpdatableClientModel):
     phone: str
 
 
-@pydantic_dataclass(kw_only=True)
+@pydantic_dataclass(kw_only=True, slots=True)
 class ClientModel(MinimalClientModel):
     lastLogin: str = field(default="11/11/1111")
     createTimeUTCSecs: int = field(
@@ -247,6 +257,58 @@ class ClientModelResponse(CommonResponse):
 @pydantic_dataclass
 class ClientsModelResponse(CommonResponse):
     clients: List[ClientModel] | None = None
+    nextCursor: str | None = None
+
+
+class ClientImportStatus(StrEnum):
+    created = "created"
+    updated = "updated"
+    invalid = "invalid"
+    failed = "failed"
+
+
+@dataclass
+class ClientImportResult:
+    row: int
+    status: ClientImportStatus
+    phone: str | None = None
+    error: str | None = None
+
+
+@dataclass
+class ClientImportResponse(CommonResponse):
+    created: int = 0
+    updated: int = 0
+    invalid: int = 0
+    failed: int = 0
+    results: List[ClientImportResult] = field(default_factory=list)
+
+
+class JobStatus(StrEnum):
+    running = "running"
+    done = "done"
+    failed = "failed"
+    # The target was written again before the job removed it, so it was kept
+    cancelled = "cancelled"
+
+
+@dataclass
+class Job:
+    jobId: str
+    kind: str
+    target: str
+    status: JobStatus = field(default=JobStatus.running)
+    deleted: int = field(default=0)
+    error: str | None = field(default=None)
+    attempts: int = field(default=0)
+    leaseUntilUTCSecs: int = field(default=0)
+    createTimeUTCSecs: int = field(default_factory=lambda: int(time()))
+    updateTimeUTCSecs: int = field(default_factory=lambda: int(time()))
+
+
+@dataclass
+class JobResponse(CommonResponse):
+    job: Job | None = None
 
 
 @pydantic_dataclass(kw_only=True)
@@ -344,3 +406,48 @@ class BusinessUserListResponse(CommonResponse):
 @pydantic_dataclass
 class BusinessListResponse(CommonResponse):
     result: List[Business] = field(default_factory=lambda: [])
+
+
+@dataclass
+class RouteOpStats:
+    route: str
+    requests: int = 0
+    reads: int = 0
+    writes: int = 0
+    deletes: int = 0
+    calls: int = 0
+    ms: float = 0
+
+
+@dataclass
+class FirestoreMetricsResponse(CommonResponse):
+    routes: List[RouteOpStats] = field(default_factory=lambda: [])
+
+
+@dataclass
+class SingleFlightStats:
+    name: str
+    calls: int = 0
+    executed: int = 0
+    coalesced: int = 0
+    timeouts: int = 0
+
+
+@dataclass
+class SingleFlightMetricsResponse(CommonResponse):
+    flights: List[SingleFlightStats] = field(default_factory=lambda: [])
+
+
+@dataclass
+class TokenCacheStats:
+    hits: int = 0
+    misses: int = 0
+    size: int = 0
+    maxSize: int = 0
+    certRefreshes: int = 0
+    certRefreshFailures: int = 0
+
+
+@dataclass
+class TokenCacheMetricsResponse(CommonResponse):
+    tokens: TokenCacheStats | None = None
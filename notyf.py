@@ -1,15 +1,22 @@
 from asyncio import create_task, gather
 from copy import deepcopy
 from dataclasses import asdict
-from typing import List
+from functools import cached_property
+from typing import Dict, List
 
 from arrow import get
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pydantic import TypeAdapter
 
 from common import generate_id
 from constants import date_format2
-from database import FcmResult, SendNotyf, fsdb, send_fcm_message, send_sms
+from database import (
+    FcmResult,
+    SendNotyf,
+    fsdb,
+    select_fields,
+    send_fcm_message,
+    send_sms,
+)
 from model import (
     CommonDocument,
     DatabaseCalendar,
@@ -18,6 +25,7 @@ from model import (
     SetAppointmentResponse,
     Subject,
 )
+from uow import UnitOfWork
 
 
 class Notyf:
@@ -34,11 +42,14 @@ class Notyf:
         self.message_path = f"users/{self.phoneNumber}/messages/{self.message_doc_id}"
         self.notification_doc_id = generate_id()
         self.notification_path = f"businesses/{self.bzz_email}/user_notifications/{self.phoneNumber}/notifications/{self.notification_doc_id}"
-        #
-        bzz_doc = f"businesses/{self.bzz_email}"
-        user_doc = f"users/{self.phoneNumber}"
-        self.bzz_data = fsdb.document(bzz_doc).get().to_dict()
-        self.user_data = fsdb.document(user_doc).get().to_dict()
+
+    @cached_property
+    def bzz_data(self) -> Dict | None:
+        return fsdb.document(f"businesses/{self.bzz_email}").get().to_dict()
+
+    @cached_property
+    def user_data(self) -> Dict | None:
+        return fsdb.document(f"users/{self.phoneNumber}").get().to_dict()
 
     def get_human_readable_message(self) -> str:
         if self.query is not None:
@@ -80,7 +91,7 @@ class Notyf:
         )
 
     async def notify(
-        self, de: DatabaseEvent, cal: DatabaseCalendar
+        self, de: DatabaseEvent, cal: DatabaseCalendar, uow: UnitOfWork | None = None
     ) -> SetAppointmentResponse:
         msg = self.get_message_doc_data()
         msg.calendarId = cal.calendarId
@@ -97,29 +108,27 @@ class Notyf:
         nty.docPath = self.notification_path
         nty.otherDocPath = self.message_path
         #
-        fsdb.document(self.message_path).set(asdict(msg))
-        fsdb.document(self.notification_path).set(asdict(nty))
+        _uow = uow if uow is not None else UnitOfWork()
+        _uow.set(self.message_path, asdict(msg))
+        _uow.set(self.notification_path, asdict(nty))
+        if uow is None:
+            await _uow.commit()
         return SetAppointmentResponse(success=True, result=de)
 
     @staticmethod
     def update(business: str, calendarId: str, eventId: str, update_data: dict):
-        messages = (
+        messages = select_fields(
             fsdb.collection_group("messages")
             .where(filter=FieldFilter("calendarId", "==", calendarId))
             .where(filter=FieldFilter("calendarEventId", "==", eventId))
             .where(filter=FieldFilter("business", "==", business))
-            .limit(1)
-            .get()
+            .limit(1),
+            ["docPath"],
         )
         if len(messages) > 0:
-            _t = messages[0].to_dict()
-            data = (
-                TypeAdapter(CommonDocument).validate_python(_t)
-                if _t is not None
-                else None
-            )
-            if data is not None and data.docPath is not None:
-                fsdb.document(data.docPath).update(update_data)
+            docPath = messages[0].get("docPath")
+            if docPath:
+                fsdb.document(docPath).update(update_data)
 
     @staticmethod
     async def send_fcm_messages(sns: List[SendNotyf]) -> List[FcmResult]:
@@ -130,8 +139,11 @@ class Notyf:
                 filter(
                     lambda x: x is not None,
                     map(
-                        lambda x: x.to_dict().get("token"),
-                        fsdb.collection(f"users/{sn.phoneNumber}/tokens").get(),
+                        lambda x: x.get("token"),
+                        select_fields(
+                            fsdb.collection(f"users/{sn.phoneNumber}/tokens"),
+                            ["token"],
+                        ),
                     ),
                 )
             )
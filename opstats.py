@@ -0,0 +1,365 @@
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from threading import Lock
+from time import perf_counter
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+
+from google.cloud.firestore import transactional
+
+from model import RouteOpStats
+from slowlog import path_pattern, slow_log
+
+
+@dataclass
+class OpStats:
+    reads: int = 0
+    writes: int = 0
+    deletes: int = 0
+    calls: int = 0
+    ms: float = 0
+    lock: Lock = field(default_factory=Lock, repr=False, compare=False)
+
+    def add(self, reads: int = 0, writes: int = 0, deletes: int = 0, ms: float = 0):
+        with self.lock:
+            self.reads += reads
+            self.writes += writes
+            self.deletes += deletes
+            self.calls += 1
+            self.ms += ms
+
+
+# The stats of the request being served, threads started with to_thread share it
+current_stats: ContextVar[OpStats | None] = ContextVar("current_stats", default=None)
+
+route_stats: Dict[str, RouteOpStats] = {}
+route_stats_lock = Lock()
+
+
+def start_request() -> OpStats:
+    stats = OpStats()
+    current_stats.set(stats)
+    return stats
+
+
+def finish_request(route: str | None, stats: OpStats) -> Dict[str, str]:
+    """
+    Adds the request to the aggregate of its route and returns the response headers.
+    Requests that matched no route aren't aggregated.
+    """
+    if route is not None:
+        aggregate(route, stats)
+    return stats_headers(stats)
+
+
+def stats_headers(stats: OpStats) -> Dict[str, str]:
+    return {
+        "X-Firestore-Reads": str(stats.reads),
+        "X-Firestore-Writes": str(stats.writes),
+        "X-Firestore-Deletes": str(stats.deletes),
+        "X-Firestore-Calls": str(stats.calls),
+        "X-Firestore-Ms": f"{stats.ms:.1f}",
+    }
+
+
+def aggregate(route: str, stats: OpStats) -> None:
+    with route_stats_lock:
+        _t = route_stats.get(route)
+        if _t is None:
+            _t = route_stats[route] = RouteOpStats(route=route)
+        _t.requests += 1
+        _t.reads += stats.reads
+        _t.writes += stats.writes
+        _t.deletes += stats.deletes
+        _t.calls += stats.calls
+        _t.ms += stats.ms
+
+
+def get_route_stats() -> List[RouteOpStats]:
+    with route_stats_lock:
+        return [RouteOpStats(**vars(z)) for z in route_stats.values()]
+
+
+def timed(
+    fn: Callable[[], Any],
+    count: Callable[[Any], Tuple[int, int, int]],
+    shape: Dict[str, Any],
+) -> Any:
+    """
+    Runs a storage call, records its reads, writes and deletes against the request and
+    hands it to the slow operation log along with the shape of the call.
+    """
+    t = perf_counter()
+    result = fn()
+    ms = (perf_counter() - t) * 1000
+    reads, writes, deletes = count(result)
+    stats = current_stats.get()
+    if stats is not None:
+        stats.add(reads, writes, deletes, ms)
+    slow_log.observe(
+        shape, len(result) if isinstance(result, list) else reads + writes + deletes, ms
+    )
+    return result
+
+
+def _filter_shape(*args, **kwargs) -> Tuple[str, str]:
+    # Only the field and the operator, the values can be personal data
+    _f = kwargs.get("filter")
+    if _f is not None:
+        return (str(_f.field_path), str(_f.op_string))
+    field_path = kwargs.get("field_path", args[0] if len(args) > 0 else None)
+    op_string = kwargs.get("op_string", args[1] if len(args) > 1 else None)
+    return (str(field_path), str(op_string))
+
+
+def _unwrap(z: Any) -> Any:
+    return z.inner if isinstance(z, (InstrumentedDocument, InstrumentedQuery)) else z
+
+
+class InstrumentedDocument:
+    def __init__(self, inner: Any) -> None:
+        self.inner = inner
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    def _shape(self, op: str) -> Dict[str, Any]:
+        return {"op": f"document.{op}", "path": path_pattern(self.inner.path)}
+
+    def collection(self, collection_id: str) -> "InstrumentedQuery":
+        return InstrumentedQuery(
+            self.inner.collection(collection_id),
+            {"path": path_pattern(f"{self.inner.path}/{collection_id}")},
+        )
+
+    def get(self, *args, **kwargs) -> Any:
+        return timed(
+            lambda: self.inner.get(*args, **kwargs),
+            lambda _: (1, 0, 0),
+            self._shape("get"),
+        )
+
+    def collections(self, *args, **kwargs) -> List["InstrumentedQuery"]:
+        return [
+            InstrumentedQuery(z, {"path": path_pattern(f"{self.inner.path}/{z.id}")})
+            for z in timed(
+                lambda: list(self.inner.collections(*args, **kwargs)),
+                lambda _: (0, 0, 0),
+                self._shape("collections"),
+            )
+        ]
+
+    def set(self, *args, **kwargs) -> Any:
+        return timed(
+            lambda: self.inner.set(*args, **kwargs),
+            lambda _: (0, 1, 0),
+            self._shape("set"),
+        )
+
+    def create(self, *args, **kwargs) -> Any:
+        return timed(
+            lambda: self.inner.create(*args, **kwargs),
+            lambda _: (0, 1, 0),
+            self._shape("create"),
+        )
+
+    def update(self, *args, **kwargs) -> Any:
+        return timed(
+            lambda: self.inner.update(*args, **kwargs),
+            lambda _: (0, 1, 0),
+            self._shape("update"),
+        )
+
+    def delete(self, *args, **kwargs) -> Any:
+        return timed(
+            lambda: self.inner.delete(*args, **kwargs),
+            lambda _: (0, 0, 1),
+            self._shape("delete"),
+        )
+
+
+class InstrumentedQuery:
+    def __init__(self, inner: Any, shape: Dict[str, Any]) -> None:
+        self.inner = inner
+        # How the query was built, for the slow operation log
+        self.shape = shape
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    def _chain(self, inner: Any, key: str, value: Any) -> "InstrumentedQuery":
+        if key in ("filters", "orders"):
+            value = [*self.shape.get(key, []), value]
+        return InstrumentedQuery(inner, {**self.shape, key: value})
+
+    def document(self, *args, **kwargs) -> InstrumentedDocument:
+        return InstrumentedDocument(self.inner.document(*args, **kwargs))
+
+    def where(self, *args, **kwargs) -> "InstrumentedQuery":
+        return self._chain(
+            self.inner.where(*args, **kwargs),
+            "filters",
+            _filter_shape(*args, **kwargs),
+        )
+
+    def order_by(self, *args, **kwargs) -> "InstrumentedQuery":
+        return self._chain(
+            self.inner.order_by(*args, **kwargs),
+            "orders",
+            str(kwargs.get("field_path", args[0] if len(args) > 0 else None)),
+        )
+
+    def limit(self, count: int) -> "InstrumentedQuery":
+        return self._chain(self.inner.limit(count), "limit", count)
+
+    def select(self, field_paths: Iterable[str]) -> "InstrumentedQuery":
+        field_paths = list(field_paths)
+        return self._chain(self.inner.select(field_paths), "select", field_paths)
+
+    def start_after(self, *args, **kwargs) -> "InstrumentedQuery":
+        return self._chain(self.inner.start_after(*args, **kwargs), "cursor", True)
+
+    def get(self, *args, **kwargs) -> List[Any]:
+        # A query costs at least one read even when nothing matches
+        return timed(
+            lambda: list(self.inner.get(*args, **kwargs)),
+            lambda z: (max(1, len(z)), 0, 0),
+            {"op": "query.get", **self.shape},
+        )
+
+    def stream(self, *args, **kwargs) -> Iterator[Any]:
+        stats = current_stats.get()
+        t = perf_counter()
+        reads = 0
+        ms = 0.0
+        try:
+            for z in self.inner.stream(*args, **kwargs):
+                reads += 1
+                ms += (perf_counter() - t) * 1000
+                yield z
+                t = perf_counter()
+            ms += (perf_counter() - t) * 1000
+        finally:
+            if stats is not None:
+                stats.add(reads=max(1, reads), ms=ms)
+            slow_log.observe({"op": "query.stream", **self.shape}, reads, ms)
+
+
+class InstrumentedBatch:
+    def __init__(self, inner: Any) -> None:
+        self.inner = inner
+        self.writes = 0
+        self.deletes = 0
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    def set(self, reference: Any, *args, **kwargs) -> None:
+        self.writes += 1
+        self.inner.set(_unwrap(reference), *args, **kwargs)
+
+    def create(self, reference: Any, *args, **kwargs) -> None:
+        self.writes += 1
+        self.inner.create(_unwrap(reference), *args, **kwargs)
+
+    def update(self, reference: Any, *args, **kwargs) -> None:
+        self.writes += 1
+        self.inner.update(_unwrap(reference), *args, **kwargs)
+
+    def delete(self, reference: Any, *args, **kwargs) -> None:
+        self.deletes += 1
+        self.inner.delete(_unwrap(reference), *args, **kwargs)
+
+    def commit(self, *args, **kwargs) -> Any:
+        writes, deletes = self.writes, self.deletes
+        self.writes = self.deletes = 0
+        return timed(
+            lambda: self.inner.commit(*args, **kwargs),
+            lambda _: (0, writes, deletes),
+            {"op": "batch.commit", "writes": writes, "deletes": deletes},
+        )
+
+
+class InstrumentedTransaction(InstrumentedBatch):
+    def __init__(self, inner: Any) -> None:
+        super().__init__(inner)
+        self.reads = 0
+
+    def get_all(self, references: Iterable[Any]) -> List[Any]:
+        refs = [_unwrap(z) for z in references]
+        self.reads += len(refs)
+        return list(self.inner.get_all(refs))
+
+
+class InstrumentedStorage:
+    """
+    Wraps a storage backend and counts the reads, writes, deletes and round trip time of
+    every call against the request it was made for, see start_request.
+    """
+
+    def __init__(self, inner: Any) -> None:
+        self.inner = inner
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.inner, name)
+
+    def document(self, *document_path: str) -> InstrumentedDocument:
+        return InstrumentedDocument(self.inner.document(*document_path))
+
+    def collection(self, *collection_path: str) -> InstrumentedQuery:
+        return InstrumentedQuery(
+            self.inner.collection(*collection_path),
+            {"path": path_pattern("/".join(collection_path))},
+        )
+
+    def collection_group(self, collection_id: str) -> InstrumentedQuery:
+        return InstrumentedQuery(
+            self.inner.collection_group(collection_id),
+            {"collectionGroup": collection_id},
+        )
+
+    def batch(self) -> InstrumentedBatch:
+        return InstrumentedBatch(self.inner.batch())
+
+    def run_transaction(self, fn: Callable[[Any], Any]) -> Any:
+        """
+        Runs fn with a transaction, the documents it reads through transaction.get_all and
+        its writes commit together. fn runs again when the transaction is contended.
+        """
+        attempts: List[InstrumentedTransaction] = []
+
+        def attempt(transaction: Any) -> Any:
+            attempts.append(InstrumentedTransaction(transaction))
+            return fn(attempts[-1])
+
+        run = getattr(self.inner, "run_transaction", None)
+        return timed(
+            lambda: run(attempt)
+            if run is not None
+            else transactional(attempt)(self.inner.transaction()),
+            lambda _: (
+                sum(z.reads for z in attempts),
+                sum(z.writes for z in attempts),
+                sum(z.deletes for z in attempts),
+            ),
+            {"op": "transaction"},
+        )
+
+    def get_all(self, references: Iterable[Any], *args, **kwargs) -> List[Any]:
+        refs = [_unwrap(z) for z in references]
+        return timed(
+            lambda: list(self.inner.get_all(refs, *args, **kwargs)),
+            lambda z: (len(z), 0, 0),
+            {"op": "get_all", "documents": len(refs)},
+        )
+
+    def recursive_delete(self, reference: Any, *args, **kwargs) -> int:
+        reference = _unwrap(reference)
+        path = getattr(reference, "path", None)
+        return timed(
+            lambda: self.inner.recursive_delete(reference, *args, **kwargs),
+            lambda z: (0, 0, z),
+            {
+                "op": "recursive_delete",
+                "path": path_pattern(path) if path is not None else reference.id,
+            },
+        )
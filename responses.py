@@ -0,0 +1,30 @@
+from contextvars import ContextVar
+from dataclasses import asdict, is_dataclass
+from typing import Any
+
+from fastapi.responses import ORJSONResponse
+from msgpack import packb
+
+msgpack_types = (b"application/msgpack", b"application/x-msgpack")
+
+# Set by the middleware for the request being handled, from its Accept header
+wants_msgpack: ContextVar[bool] = ContextVar("wants_msgpack", default=False)
+
+
+def _msgpack_default(value: Any) -> Any:
+    if is_dataclass(value) and not isinstance(value, type):
+        return asdict(value)
+    raise TypeError(f"Can't serialize {type(value).__name__} to msgpack")
+
+
+class NegotiatedResponse(ORJSONResponse):
+    """
+    JSON, or MessagePack for clients that accept application/msgpack, which is smaller
+    and quicker to parse on mobile.
+    """
+
+    def render(self, content: Any) -> bytes:
+        if wants_msgpack.get():
+            self.media_type = "application/msgpack"
+            return packb(content, default=_msgpack_default)
+        return super().render(content)
@@ -0,0 +1,65 @@
+from asyncio import Task, create_task, get_running_loop, shield, to_thread, wait_for
+from typing import Callable, Dict, Hashable, List, TypeVar
+
+from model import SingleFlightStats
+
+T = TypeVar("T")
+
+flights: List["SingleFlight"] = []
+
+
+class SingleFlight:
+    """
+    Coalesces identical concurrent fetches, while the fetch for a key is in flight every
+    other caller asking for the same key awaits its result instead of fetching again.
+
+    Callers stop waiting after the timeout and get a TimeoutError, the stuck fetch is then
+    forgotten so the next caller starts a fresh one.
+    """
+
+    def __init__(self, name: str, timeout: float | None = 10) -> None:
+        self.name = name
+        self.timeout = timeout
+        self.calls: Dict[Hashable, Task] = {}
+        self.stats = SingleFlightStats(name=name)
+        flights.append(self)
+
+    def _forget(self, key: Hashable, task: Task) -> None:
+        if self.calls.get(key) is task:
+            del self.calls[key]
+
+    def _done(self, key: Hashable, task: Task) -> None:
+        self._forget(key, task)
+        if not task.cancelled():
+            # Retrieved so a failure nobody waited for isn't reported as unhandled
+            _ = task.exception()
+
+    async def do(
+        self, key: Hashable, fn: Callable[[], T], timeout: float | None = None
+    ) -> T:
+        """
+        Runs the blocking fn in a thread, unless a fetch for the key is already in flight.
+        """
+        self.stats.calls += 1
+        task = self.calls.get(key)
+        if task is not None and task.get_loop() is not get_running_loop():
+            task = None
+        if task is None:
+            self.stats.executed += 1
+            task = create_task(to_thread(fn))
+            self.calls[key] = task
+            task.add_done_callback(lambda z: self._done(key, z))
+        else:
+            self.stats.coalesced += 1
+        try:
+            return await wait_for(
+                shield(task), timeout if timeout is not None else self.timeout
+            )
+        except TimeoutError:
+            self.stats.timeouts += 1
+            self._forget(key, task)
+            raise
+
+
+def get_flight_stats() -> List[SingleFlightStats]:
+    return [SingleFlightStats(**vars(z.stats)) for z in flights]
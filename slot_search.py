@@ -211,9 +211,8 @@ class SlotSearch:
                 )
                 gaps.append(slot)
 
-        _gaps.clear()
-        _gaps = deepcopy(gaps)
-        gaps.clear()
+        # The gaps kept are only referenced from here on, no need to copy them
+        _gaps, gaps = gaps, []
 
         duration, _break = self.calendar.durationMins, self.calendar.breakMins
         required_time = duration * 60 + _break * 60
@@ -0,0 +1,75 @@
+from json import dumps
+from logging import getLogger
+from os import environ
+from random import random
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Dict
+
+logger = getLogger("lookahead.slowops")
+
+# Calls at or over this many milliseconds are candidates for the log
+threshold_ms = float(environ.get("LOOKAHEAD_SLOW_OP_MS", "500"))
+# Fraction of the slow calls that get logged
+sample_rate = float(environ.get("LOOKAHEAD_SLOW_OP_SAMPLE", "1"))
+# Upper bound on the entries written per minute, the rest are counted as suppressed
+max_per_minute = int(environ.get("LOOKAHEAD_SLOW_OP_PER_MIN", "60"))
+
+
+def path_pattern(path: str) -> str:
+    """
+    businesses/a@b.com/calendars/x1/events -> businesses/*/calendars/*/events
+    Document ids carry emails and phone numbers, so only the shape of the path is logged.
+    """
+    return "/".join(z if i % 2 == 0 else "*" for i, z in enumerate(path.split("/")))
+
+
+class SlowLog:
+    def __init__(self) -> None:
+        self.lock = Lock()
+        self.tokens = float(max_per_minute)
+        self.refilled_at = monotonic()
+        self.suppressed = 0
+
+    def _take(self) -> int | None:
+        """
+        Token bucket, returns how many entries were suppressed since the last one written
+        or None when this one has to be suppressed as well.
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(
+                float(max_per_minute),
+                self.tokens + (now - self.refilled_at) * max_per_minute / 60,
+            )
+            self.refilled_at = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return None
+            self.tokens -= 1
+            suppressed, self.suppressed = self.suppressed, 0
+            return suppressed
+
+    def observe(self, shape: Dict[str, Any], result_count: int, ms: float) -> None:
+        if ms < threshold_ms or random() >= sample_rate:
+            return
+        suppressed = self._take()
+        if suppressed is None:
+            return
+        logger.warning(
+            dumps(
+                {
+                    "severity": "WARNING",
+                    "message": "slow firestore operation",
+                    "timestamp": time(),
+                    **shape,
+                    "resultCount": result_count,
+                    "ms": round(ms, 1),
+                    "thresholdMs": threshold_ms,
+                    "suppressed": suppressed,
+                }
+            )
+        )
+
+
+slow_log = SlowLog()
@@ -0,0 +1,400 @@
+from copy import deepcopy
+from threading import RLock
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Protocol, Tuple
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+
+document_id = "__name__"
+
+
+class Storage(Protocol):
+    """
+    The part of the firestore client API the app relies on, what fsdb is. InstrumentedStorage
+    provides it over google.cloud.firestore.Client, whose run_transaction it builds from
+    transactional, and MemoryStorage implements it in process.
+    """
+
+    def document(self, *document_path: str) -> Any: ...
+
+    def collection(self, *collection_path: str) -> Any: ...
+
+    def collection_group(self, collection_id: str) -> Any: ...
+
+    def batch(self) -> Any: ...
+
+    def get_all(
+        self, references: list, field_paths: Iterable[str] | None = None
+    ) -> Any: ...
+
+    def run_transaction(self, fn: Callable[[Any], Any]) -> Any: ...
+
+    def recursive_delete(
+        self, reference: Any, *, chunk_size: int | None = 5000
+    ) -> int: ...
+
+
+def _join(path: Tuple[str, ...]) -> str:
+    return "/".join(z.strip("/") for z in path if z != "")
+
+
+def _type_rank(value: Any) -> int:
+    # Firestore orders values of different types by type first
+    if value is None:
+        return 0
+    if isinstance(value, bool):
+        return 1
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    return 4
+
+
+def _sort_key(value: Any) -> Tuple[int, Any]:
+    rank = _type_rank(value)
+    return (rank, value if rank < 4 else str(value))
+
+
+def _compare(a: Any, b: Any) -> int:
+    ka, kb = _sort_key(a), _sort_key(b)
+    return (ka > kb) - (ka < kb)
+
+
+def _matches(value: Any, op: str, expected: Any) -> bool:
+    if op == "==":
+        return value == expected
+    if op == "!=":
+        return value != expected
+    if op in ("<", "<=", ">", ">="):
+        if _type_rank(value) != _type_rank(expected):
+            return False
+        c = _compare(value, expected)
+        return {"<": c < 0, "<=": c <= 0, ">": c > 0, ">=": c >= 0}[op]
+    if op == "in":
+        return value in expected
+    if op == "not-in":
+        return value not in expected
+    if op == "array_contains":
+        return isinstance(value, list) and expected in value
+    if op == "array_contains_any":
+        return isinstance(value, list) and any(z in value for z in expected)
+    raise ValueError(f"Unsupported operator {op}")
+
+
+class MemoryDocumentSnapshot:
+    def __init__(self, reference: "MemoryDocumentReference", data: Dict | None):
+        self.reference = reference
+        self._data = data
+
+    @property
+    def id(self) -> str:
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self) -> Dict | None:
+        return deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str) -> Any:
+        if field_path == document_id:
+            return self.id
+        return self._data.get(field_path) if self._data is not None else None
+
+
+class MemoryDocumentReference:
+    def __init__(self, storage: "MemoryStorage", path: str):
+        self._storage = storage
+        self.path = path
+
+    @property
+    def id(self) -> str:
+        return self.path.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self._storage, self.path.rsplit("/", 1)[0])
+
+    def collection(self, collection_id: str) -> "MemoryCollectionReference":
+        return MemoryCollectionReference(self._storage, f"{self.path}/{collection_id}")
+
+    def get(self, field_paths: Iterable[str] | None = None) -> MemoryDocumentSnapshot:
+        return self._storage._snapshot(self.path, field_paths)
+
+    def collections(self) -> Iterator["MemoryCollectionReference"]:
+        prefix = f"{self.path}/"
+        with self._storage._lock:
+            ids = {
+                p[len(prefix) :].split("/", 1)[0]
+                for p in self._storage._docs
+                if p.startswith(prefix)
+            }
+        for z in sorted(ids):
+            yield self.collection(z)
+
+    def set(self, document_data: Dict, merge: bool = False) -> None:
+        self._storage._commit([("set", self.path, document_data, merge)])
+
+    def create(self, document_data: Dict) -> None:
+        self._storage._commit([("create", self.path, document_data, False)])
+
+    def update(self, field_updates: Dict) -> None:
+        self._storage._commit([("update", self.path, field_updates, False)])
+
+    def delete(self) -> None:
+        self._storage._commit([("delete", self.path, None, False)])
+
+
+class MemoryQuery:
+    def __init__(
+        self,
+        storage: "MemoryStorage",
+        path: str,
+        all_descendants: bool = False,
+        filters: Tuple[Tuple[str, str, Any], ...] = (),
+        orders: Tuple[Tuple[str, str], ...] = (),
+        limit: int | None = None,
+        projection: Tuple[str, ...] | None = None,
+        cursor: Any = None,
+    ):
+        self._storage = storage
+        self._path = path
+        self._all_descendants = all_descendants
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        self._projection = projection
+        self._cursor = cursor
+
+    def _copy(self, **kwargs) -> "MemoryQuery":
+        _t = {
+            "all_descendants": self._all_descendants,
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "projection": self._projection,
+            "cursor": self._cursor,
+        }
+        _t.update(kwargs)
+        return MemoryQuery(self._storage, self._path, **_t)
+
+    def where(
+        self,
+        field_path: str | None = None,
+        op_string: str | None = None,
+        value: Any = None,
+        *,
+        filter: Any = None,
+    ) -> "MemoryQuery":
+        if filter is not None:
+            field_path, op_string, value = (
+                filter.field_path,
+                filter.op_string,
+                filter.value,
+            )
+        if field_path is None or op_string is None:
+            raise ValueError("A field path and an operator are required")
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path: str, direction: str = "ASCENDING") -> "MemoryQuery":
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int) -> "MemoryQuery":
+        return self._copy(limit=count)
+
+    def select(self, field_paths: Iterable[str]) -> "MemoryQuery":
+        return self._copy(projection=tuple(field_paths))
+
+    def start_after(self, document_fields_or_snapshot: Any) -> "MemoryQuery":
+        return self._copy(cursor=document_fields_or_snapshot)
+
+    def _cursor_orders(
+        self, orders: List[Tuple[str, str]]
+    ) -> List[Tuple[str, str, Any]]:
+        c = self._cursor
+        if isinstance(c, MemoryDocumentSnapshot):
+            return [(f, d, c.get(f)) for f, d in orders]
+        # Plain values only cover the explicit order_by fields, like firestore
+        explicit = orders[: len(self._orders)]
+        if isinstance(c, dict):
+            return [(f, d, c.get(f)) for f, d in explicit]
+        return [(f, d, v) for (f, d), v in zip(explicit, c)]
+
+    def _in_scope(self, path: str) -> bool:
+        parent = path.rsplit("/", 1)[0]
+        if self._all_descendants:
+            return parent.rsplit("/", 1)[-1] == self._path
+        return parent == self._path
+
+    def stream(self) -> Iterator[MemoryDocumentSnapshot]:
+        with self._storage._lock:
+            docs = [(p, d) for p, d in self._storage._docs.items() if self._in_scope(p)]
+
+        def value(path: str, data: Dict, field: str) -> Any:
+            return path.rsplit("/", 1)[-1] if field == document_id else data.get(field)
+
+        for f, op, v in self._filters:
+            docs = [
+                (p, d)
+                for p, d in docs
+                if (f == document_id or f in d) and _matches(value(p, d, f), op, v)
+            ]
+        # Like firestore, ordering on a field leaves out the documents without it
+        for f, _ in self._orders:
+            docs = [(p, d) for p, d in docs if f == document_id or f in d]
+        orders = list(self._orders)
+        if document_id not in map(lambda z: z[0], orders):
+            orders.append((document_id, orders[-1][1] if orders else "ASCENDING"))
+        for f, direction in reversed(orders):
+            docs.sort(
+                key=lambda z: _sort_key(value(z[0], z[1], f)),
+                reverse=direction == "DESCENDING",
+            )
+        if self._cursor is not None:
+            after = self._cursor_orders(orders)
+
+            def is_after(path: str, data: Dict) -> bool:
+                for f, direction, c in after:
+                    cmp = _compare(value(path, data, f), c)
+                    if direction == "DESCENDING":
+                        cmp = -cmp
+                    if cmp != 0:
+                        return cmp > 0
+                # Every cursor value is equal, the document is the cursor itself
+                return False
+
+            docs = [(p, d) for p, d in docs if is_after(p, d)]
+        if self._limit is not None:
+            docs = docs[: self._limit]
+        for p, d in docs:
+            if self._projection is not None:
+                d = {k: v for k, v in d.items() if k in self._projection}
+            yield MemoryDocumentSnapshot(MemoryDocumentReference(self._storage, p), d)
+
+    def get(self) -> List[MemoryDocumentSnapshot]:
+        return list(self.stream())
+
+
+class MemoryCollectionReference(MemoryQuery):
+    def __init__(self, storage: "MemoryStorage", path: str):
+        super().__init__(storage, path)
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: str) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self._storage, f"{self._path}/{document_id}")
+
+
+class MemoryWriteBatch:
+    def __init__(self, storage: "MemoryStorage"):
+        self._storage = storage
+        self._ops: List[Tuple[str, str, Dict | None, bool]] = []
+
+    def set(
+        self, reference: MemoryDocumentReference, document_data: Dict, merge=False
+    ) -> None:
+        self._ops.append(("set", reference.path, document_data, merge))
+
+    def create(self, reference: MemoryDocumentReference, document_data: Dict) -> None:
+        self._ops.append(("create", reference.path, document_data, False))
+
+    def update(self, reference: MemoryDocumentReference, field_updates: Dict) -> None:
+        self._ops.append(("update", reference.path, field_updates, False))
+
+    def delete(self, reference: MemoryDocumentReference) -> None:
+        self._ops.append(("delete", reference.path, None, False))
+
+    def commit(self) -> list:
+        self._storage._commit(self._ops)
+        ops, self._ops = self._ops, []
+        return ops
+
+
+class MemoryTransaction(MemoryWriteBatch):
+    def get_all(self, references: list) -> Iterator[MemoryDocumentSnapshot]:
+        for z in references:
+            yield self._storage._snapshot(z.path)
+
+
+class MemoryStorage:
+    """
+    In process stand-in for the firestore client, documents live in a dict keyed by path.
+    Used to run the api, its tests and benchmarks without a firebase project.
+    """
+
+    def __init__(self) -> None:
+        self._docs: Dict[str, Dict] = {}
+        self._lock = RLock()
+
+    def document(self, *document_path: str) -> MemoryDocumentReference:
+        return MemoryDocumentReference(self, _join(document_path))
+
+    def collection(self, *collection_path: str) -> MemoryCollectionReference:
+        return MemoryCollectionReference(self, _join(collection_path))
+
+    def collection_group(self, collection_id: str) -> MemoryQuery:
+        return MemoryQuery(self, collection_id, all_descendants=True)
+
+    def batch(self) -> MemoryWriteBatch:
+        return MemoryWriteBatch(self)
+
+    def get_all(
+        self, references: list, field_paths: Iterable[str] | None = None
+    ) -> Iterator[MemoryDocumentSnapshot]:
+        for z in references:
+            yield self._snapshot(z.path, field_paths)
+
+    def run_transaction(self, fn: Callable[[MemoryTransaction], Any]) -> Any:
+        """
+        What google.cloud.firestore.transactional does for the firestore client. The store
+        is locked for the whole run, so nothing else writes in between.
+        """
+        with self._lock:
+            transaction = MemoryTransaction(self)
+            result = fn(transaction)
+            transaction.commit()
+            return result
+
+    def recursive_delete(self, reference: Any, *, chunk_size: int | None = 5000) -> int:
+        prefix = f"{reference.path if isinstance(reference, MemoryDocumentReference) else reference._path}/"
+        with self._lock:
+            paths = [p for p in self._docs if p.startswith(prefix) or p == prefix[:-1]]
+            for p in paths:
+                del self._docs[p]
+        return len(paths)
+
+    def _snapshot(
+        self, path: str, field_paths: Iterable[str] | None = None
+    ) -> MemoryDocumentSnapshot:
+        with self._lock:
+            data = self._docs.get(path)
+        if data is not None and field_paths is not None:
+            fields = set(field_paths)
+            data = {k: v for k, v in data.items() if k in fields}
+        return MemoryDocumentSnapshot(MemoryDocumentReference(self, path), data)
+
+    def _commit(self, ops: List[Tuple[str, str, Dict | None, bool]]) -> None:
+        with self._lock:
+            # Preconditions are checked for every write before any is applied
+            exists = {p: p in self._docs for _, p, _, _ in ops}
+            for op, path, _, _ in ops:
+                if op == "create":
+                    if exists[path]:
+                        raise AlreadyExists(f"Document already exists: {path}")
+                    exists[path] = True
+                elif op == "update" and not exists[path]:
+                    raise NotFound(f"No document to update: {path}")
+                elif op == "set":
+                    exists[path] = True
+                elif op == "delete":
+                    exists[path] = False
+            for op, path, data, merge in ops:
+                if op == "delete":
+                    self._docs.pop(path, None)
+                elif op == "update" or (op == "set" and merge):
+                    self._docs[path] = {**self._docs.get(path, {}), **deepcopy(data)}
+                else:
+                    self._docs[path] = deepcopy(data or {})
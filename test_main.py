@@ -1,20 +1,33 @@
+from asyncio import create_task, gather, run
+from asyncio import sleep as asyncio_sleep
 from copy import deepcopy
 from dataclasses import asdict
+from json import loads
 from random import choice
+from threading import Event
+from time import sleep, time
+from types import SimpleNamespace
+from typing import Dict, List
 
 from fastapi.testclient import TestClient
 from jwt import decode as jwt_decode
+from jwt import encode as jwt_encode
+from msgpack import packb, unpackb
 from pydantic import TypeAdapter
 from pytest import fixture
 
-from common import generate_id
-from database import SendNotyf
+from common import decode_cursor, encode_cursor, generate_id
+from common2 import record_revocation
+from database import SendNotyf, fsdb, get_docs
+from jobs import get_job_path
 from la_token import bzz_uid, bzz_uid2, get_auth_tokens, user_uid, user_uid2
 from main import app
 from model import (
     BusinessListResponse,
     BusinessUserListResponse,
     CalendarResponse,
+    ClientImportResponse,
+    ClientImportStatus,
     ClientModel,
     ClientModelResponse,
     ClientsModelResponse,
@@ -25,8 +38,12 @@ from model import (
     EventResponse,
     EventStatus,
     FcmResultResponse,
+    FirestoreMetricsResponse,
     GetAppointmentsResponse,
     GetCalendarsResponse,
+    Job,
+    JobResponse,
+    JobStatus,
     MessagingRequest,
     MinimalClientModel,
     SearchAppointmentRequest,
@@ -40,10 +57,17 @@ from model import (
     TodoListResponse,
     TodoResponse,
     TodoStatus,
+    TokenCacheMetricsResponse,
     UpdatableClientModel,
     UpdateAppointmentRequest,
     UpdateCalendarRequest,
 )
+from opstats import InstrumentedStorage
+from singleflight import SingleFlight
+from slowlog import SlowLog
+from storage import MemoryQuery, MemoryStorage
+from um import BusinessUserManagement
+from uow import UnitOfWork
 
 client = TestClient(app=app)
 
@@ -120,6 +144,32 @@ def test_get_calendars():
     assert calendar.calendarId in list(map(lambda x: x.calendarId, response.items))
 
 
+def test_firestore_metrics():
+    response = client.get("/calendars", headers=bzz_headers)
+    assert int(response.headers["X-Firestore-Reads"]) > 0
+    metrics = TypeAdapter(FirestoreMetricsResponse).validate_python(
+        client.get("/metrics/firestore", headers=bzz_headers).json()
+    )
+    assert "GET /calendars" in list(map(lambda z: z.route, metrics.routes))
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get("/metrics/firestore", headers=user_headers).json()
+    )
+    assert response.success is False
+
+
+def test_token_metrics():
+    metrics = TypeAdapter(TokenCacheMetricsResponse).validate_python(
+        client.get("/metrics/tokens", headers=bzz_headers).json()
+    )
+    assert metrics.tokens is not None
+    metrics2 = TypeAdapter(TokenCacheMetricsResponse).validate_python(
+        client.get("/metrics/tokens", headers=bzz_headers).json()
+    )
+    assert metrics2.tokens is not None
+    assert metrics2.tokens.hits > metrics.tokens.hits
+    assert metrics2.tokens.misses == metrics.tokens.misses
+
+
 def test_update_calendar():
     global calendar
     _t = UpdateCalendarRequest(calendarName=f"New name - {generate_id()}")
@@ -190,6 +240,62 @@ def test_create_appointment(business):
             event = response2.result
 
 
+def test_create_appointment_client(business):
+    user_phone = f"+1415{choice(range(1000000, 9999999))}"
+    response = TypeAdapter(SetAppointmentResponse).validate_python(
+        client.post(
+            "/appointments",
+            headers=user_headers,
+            json=asdict(
+                SetAppointmentRequest(
+                    business=business,
+                    calendarId=calendar.calendarId,
+                    startTime=1797000000,
+                    endTime=1797003600,
+                    query=None,
+                    userPhone=user_phone,
+                    sendNotification=False,
+                )
+            ),
+        ).json()
+    )
+    assert response.result is not None
+    # The event, the client and the link to the business are committed together
+    assert (
+        fsdb.document(f"businesses/{business}/clients/{user_phone}").get().to_dict()
+        is not None
+    )
+    assert (
+        fsdb.document(f"users/{user_phone}/businesses/{business}").get().to_dict()
+        is not None
+    )
+
+
+def test_create_appointment_missing_calendar(business):
+    user_phone = f"+1415{choice(range(1000000, 9999999))}"
+    response = TypeAdapter(SetAppointmentResponse).validate_python(
+        client.post(
+            "/appointments",
+            headers=user_headers,
+            json=asdict(
+                SetAppointmentRequest(
+                    business=business,
+                    calendarId=generate_id(),
+                    startTime=1797000000,
+                    endTime=1797003600,
+                    query=None,
+                    userPhone=user_phone,
+                )
+            ),
+        ).json()
+    )
+    assert response.result is None
+    assert (
+        fsdb.document(f"businesses/{business}/clients/{user_phone}").get().to_dict()
+        is None
+    )
+
+
 def test_update_appointment(business):
     global event
     if event is not None:
@@ -254,15 +360,133 @@ def test_get_appointments2():
         assert event.eventId in list(map(lambda x: x.eventId, response.items))
 
 
+def test_get_appointments_sync(business):
+    global event
+    if event is not None:
+        url = f"/calendars/{event.calendarId}/appointments?startDate={event.startTime}&endDate={event.endTime}"
+        response = TypeAdapter(GetAppointmentsResponse).validate_python(
+            client.get(url, headers=bzz_headers).json()
+        )
+        assert response.syncToken is not None
+        response2 = TypeAdapter(EventResponse).validate_python(
+            client.put(
+                f"/appointments/{event.calendarId}/update/{event.eventId}",
+                headers=user_headers,
+                json=asdict(
+                    UpdateAppointmentRequest(
+                        business=business, status=EventStatus.confirmed
+                    )
+                ),
+            ).json()
+        )
+        assert response2.event is not None
+        assert response2.event.updatedAt is not None
+        assert (
+            response2.event.updatedAt > decode_cursor(response.syncToken)["updatedAt"]
+        )
+        response3 = TypeAdapter(GetAppointmentsResponse).validate_python(
+            client.get(
+                url, headers=bzz_headers, params={"syncToken": response.syncToken}
+            ).json()
+        )
+        assert response2.event in response3.items
+        assert response3.syncToken is not None
+
+
+def test_get_appointments_pages():
+    global event
+    if event is not None:
+        items = []
+        cursor = None
+        while True:
+            response = TypeAdapter(GetAppointmentsResponse).validate_python(
+                client.get(
+                    f"/calendars/{event.calendarId}/appointments",
+                    headers=bzz_headers,
+                    params={
+                        "startDate": event.startTime - 86400 * 365,
+                        "endDate": event.endTime + 86400 * 365,
+                        "pageSize": 1,
+                        "fields": "status",
+                        **({"cursor": cursor} if cursor else {}),
+                    },
+                ).json()
+            )
+            items.extend(response.items)
+            cursor = response.nextCursor
+            if cursor is None:
+                break
+        assert all(set(z) == {"eventId", "startTime", "status"} for z in items)
+        assert event.eventId in list(map(lambda z: z["eventId"], items))
+        assert list(map(lambda z: z["startTime"], items)) == sorted(
+            map(lambda z: z["startTime"], items)
+        )
+
+
 def test_delete_calendar():
     global calendar
     if calendar is not None:
-        response = TypeAdapter(CommonResponse).validate_python(
+        response = TypeAdapter(JobResponse).validate_python(
             client.delete(
                 f"/calendars/{calendar.calendarId}", headers=bzz_headers
             ).json()
         )
         assert response.success is True
+        assert response.job is not None
+        response2 = TypeAdapter(GetCalendarsResponse).validate_python(
+            client.get("/calendars", headers=bzz_headers).json()
+        )
+        assert calendar.calendarId not in list(
+            map(lambda z: z.calendarId, response2.items)
+        )
+        for _ in range(60):
+            response3 = TypeAdapter(JobResponse).validate_python(
+                client.get(f"/jobs/{response.job.jobId}", headers=bzz_headers).json()
+            )
+            assert response3.job is not None
+            if response3.job.status != JobStatus.running:
+                break
+            sleep(1)
+        assert response3.job.status == JobStatus.done
+
+
+def test_deleted_calendar_events_absent(business):
+    response = TypeAdapter(CalendarResponse).validate_python(
+        client.post("/calendars", headers=bzz_headers, json=asdict(calendar)).json()
+    )
+    assert response.calendar is not None
+    path = f"businesses/{business}/calendars/{response.calendar.calendarId}"
+    fsdb.document(f"{path}/events/e1").set(
+        asdict(
+            DatabaseEvent(
+                calendarId=response.calendar.calendarId,
+                summary="Appointment",
+                description="",
+                status=EventStatus.confirmed,
+                customer="+14155550101",
+                startTime=1700000000,
+                endTime=1700001800,
+                eventId="e1",
+                updatedAt=1700000000000,
+            )
+        )
+    )
+    url = f"/calendars/{response.calendar.calendarId}/appointments?startDate=1699990000&endDate=1700010000"
+    response2 = TypeAdapter(GetAppointmentsResponse).validate_python(
+        client.get(url, headers=bzz_headers).json()
+    )
+    assert [z.eventId for z in response2.items] == ["e1"]
+    # Marked the way a delete job still running leaves it
+    fsdb.document(path).set({"deleted": True, "deleteJobId": "running"}, merge=True)
+    for params in (
+        {},
+        {"pageSize": 10},
+        {"syncToken": encode_cursor({"updatedAt": 0})},
+    ):
+        response3 = TypeAdapter(GetAppointmentsResponse).validate_python(
+            client.get(url, headers=bzz_headers, params=params).json()
+        )
+        assert response3.items == []
 
 
 cm: ClientModel | None = None
@@ -283,6 +507,18 @@ def test_create_client(phone_number):
     cm = response.client
 
 
+def test_create_client_invalid():
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.post(
+            "/clientManagement", headers=bzz_headers, json={"name": "John"}
+        ).json()
+    )
+    assert response.success is False
+    assert isinstance(response.message, list)
+    assert response.message[0]["type"] == "missing"
+    assert response.message[0]["loc"] == ["body", "phone"]
+
+
 def test_update_client(phone_number):
     global cm
     if cm is not None:
@@ -318,6 +554,55 @@ def test_get_client(phone_number):
         cm = response.client
 
 
+def test_msgpack(phone_number):
+    global cm
+    if cm is not None:
+        _t = client.get(
+            f"/clientManagement/{phone_number}",
+            headers={**bzz_headers, "Accept": "application/msgpack"},
+        )
+        assert _t.headers["content-type"] == "application/msgpack"
+        response = TypeAdapter(ClientModelResponse).validate_python(unpackb(_t.content))
+        assert response.client is not None
+        assert response.client.phone == phone_number
+        response = TypeAdapter(CommonResponse).validate_python(
+            client.post(
+                "/clientManagement",
+                headers={**bzz_headers, "Content-Type": "application/msgpack"},
+                content=packb({"name": "John"}),
+            ).json()
+        )
+        assert response.success is False
+        assert response.message[0]["loc"] == ["body", "phone"]
+
+
+def test_msgpack_invalid_body():
+    headers = {**bzz_headers, "Content-Type": "application/msgpack"}
+    for content, message in [
+        (b"", "Empty msgpack body"),
+        (b"\xc1", "Invalid msgpack body"),
+        (packb({"name": b"John"}), "The msgpack body holds a value JSON has no type"),
+    ]:
+        _t = client.post("/clientManagement", headers=headers, content=content)
+        assert _t.status_code == 400
+        response = TypeAdapter(CommonResponse).validate_python(_t.json())
+        assert response.success is False
+        assert response.message.startswith(message)
+
+
+def test_msgpack_accept_quality():
+    for accept, msgpack in [
+        ("application/msgpack", True),
+        ("application/json;q=0.5, application/msgpack", True),
+        ("application/msgpack;q=0", False),
+        ("application/msgpack;q=0.5, application/json", False),
+        ("*/*", False),
+        ("text/html, application/x-msgpack;q=0.9, */*;q=0.8", True),
+    ]:
+        _t = client.get("/um/businesses", headers={**bzz_headers, "Accept": accept})
+        assert (_t.headers["content-type"] == "application/msgpack") is msgpack
+
+
 def test_get_clients(phone_number):
     global cm
     if cm is not None:
@@ -337,6 +622,126 @@ def test_get_clients(phone_number):
         assert present is True
 
 
+def test_get_clients_pages(phone_number):
+    global cm
+    if cm is not None:
+        phones = []
+        cursor = None
+        while True:
+            response = TypeAdapter(ClientsModelResponse).validate_python(
+                client.get(
+                    "/clientManagement",
+                    headers=bzz_headers,
+                    params={"limit": 1, **({"cursor": cursor} if cursor else {})},
+                ).json()
+            )
+            assert response.clients is not None
+            phones.extend(map(lambda z: z.phone, response.clients))
+            cursor = response.nextCursor
+            if cursor is None:
+                break
+        assert phone_number in phones
+        assert phones == sorted(phones)
+
+
+def test_get_clients_invalid_page():
+    response = TypeAdapter(ClientsModelResponse).validate_python(
+        client.get("/clientManagement", headers=bzz_headers, params={"limit": 0}).json()
+    )
+    assert response.success is True
+    assert response.clients is not None and len(response.clients) <= 1
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get(
+            "/clientManagement", headers=bzz_headers, params={"cursor": "nope"}
+        ).json()
+    )
+    assert response.success is False
+    assert response.message == "Invalid cursor"
+
+
+def test_export_clients(phone_number):
+    global cm
+    if cm is not None:
+        response = client.get("/clientManagement/export", headers=bzz_headers)
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        clients = list(
+            map(
+                lambda z: TypeAdapter(ClientModel).validate_json(z),
+                response.text.splitlines(),
+            )
+        )
+        assert phone_number in list(map(lambda z: z.phone, clients))
+        # The reads of the stream happen after the headers, they still reach the metrics
+        assert "X-Firestore-Reads" not in response.headers
+        metrics = TypeAdapter(FirestoreMetricsResponse).validate_python(
+            client.get("/metrics/firestore", headers=bzz_headers).json()
+        )
+        export = [
+            z for z in metrics.routes if z.route == "GET /clientManagement/export"
+        ]
+        assert len(export) == 1 and export[0].reads > 0
+
+
+def test_search_clients(phone_number):
+    global cm
+    if cm is not None and cm.name is not None:
+        for q in [cm.name.split(" ")[-1][:3].lower(), phone_number[-10:-4]]:
+            response = TypeAdapter(ClientsModelResponse).validate_python(
+                client.get(
+                    "/clientManagement/search",
+                    headers=bzz_headers,
+                    params={"q": q},
+                ).json()
+            )
+            assert response.clients is not None
+            assert phone_number in list(map(lambda z: z.phone, response.clients))
+
+
+def test_import_clients(phone_number):
+    global cm
+    if cm is not None:
+        new_client_name = f"John {generate_id(length=5)}"
+        response = TypeAdapter(ClientImportResponse).validate_python(
+            client.post(
+                "/clientManagement/import",
+                headers={**bzz_headers, "Content-Type": "text/csv"},
+                content=(
+                    f"phone,name\n{phone_number},John\n,Nobody\n"
+                    f"{phone_number},{new_client_name}\n"
+                ),
+            ).json()
+        )
+        assert response.success is True
+        assert [z.status for z in response.results] == [
+            ClientImportStatus.updated,
+            ClientImportStatus.invalid,
+            ClientImportStatus.updated,
+        ]
+        response2 = TypeAdapter(ClientModelResponse).validate_python(
+            client.get(f"/clientManagement/{phone_number}", headers=bzz_headers).json()
+        )
+        assert response2.client is not None
+        assert response2.client.name == new_client_name
+
+
+def test_import_clients_quoted_newline(phone_number):
+    response = TypeAdapter(ClientImportResponse).validate_python(
+        client.post(
+            "/clientManagement/import",
+            headers={**bzz_headers, "Content-Type": "text/csv"},
+            content=f'phone,name\r\n{phone_number},"John\nSmith, ""Jr"""\r\n',
+        ).json()
+    )
+    assert response.success is True
+    assert len(response.results) == 1
+    assert response.results[0].status != ClientImportStatus.invalid
+    response2 = TypeAdapter(ClientModelResponse).validate_python(
+        client.get(f"/clientManagement/{phone_number}", headers=bzz_headers).json()
+    )
+    assert response2.client is not None
+    assert response2.client.name == 'John\nSmith, "Jr"'
+
+
 def test_delete_client(phone_number):
     global cm
     if cm is not None:
@@ -350,6 +755,109 @@ def test_delete_client(phone_number):
         assert response.success is True
 
 
+def test_deleted_client_is_absent(business):
+    phone = "+14155550188"
+    path = f"businesses/{business}/clients/{phone}"
+    response = TypeAdapter(ClientModelResponse).validate_python(
+        client.post(
+            "/clientManagement",
+            headers=bzz_headers,
+            json=asdict(MinimalClientModel(phone=phone, name="John")),
+        ).json()
+    )
+    assert response.client is not None
+    # Marked the way a delete job still running leaves it
+    fsdb.document(path).set({"deleted": True, "deleteJobId": "running"}, merge=True)
+    response2 = TypeAdapter(ClientModelResponse).validate_python(
+        client.get(f"/clientManagement/{phone}", headers=bzz_headers).json()
+    )
+    assert response2.success is False
+    assert response2.client is None
+    response3 = TypeAdapter(ClientModelResponse).validate_python(
+        client.put(
+            f"/clientManagement/{phone}",
+            headers=bzz_headers,
+            json=asdict(UpdatableClientModel(name="Jane")),
+        ).json()
+    )
+    assert response3.success is False
+    assert fsdb.document(path).get().to_dict()["name"] == "John"
+    # Creating the client again replaces the mark
+    response4 = TypeAdapter(ClientModelResponse).validate_python(
+        client.post(
+            "/clientManagement",
+            headers=bzz_headers,
+            json=asdict(MinimalClientModel(phone=phone, name="Jane")),
+        ).json()
+    )
+    assert response4.client is not None
+    assert response4.client.name == "Jane"
+    assert "deleted" not in fsdb.document(path).get().to_dict()
+
+
+def wait_for_job(jobId: str) -> Job:
+    for _ in range(60):
+        response = TypeAdapter(JobResponse).validate_python(
+            client.get(f"/jobs/{jobId}", headers=bzz_headers).json()
+        )
+        assert response.job is not None
+        if response.job.status != JobStatus.running:
+            return response.job
+        sleep(1)
+    raise AssertionError(f"Job {jobId} still running")
+
+
+def left_behind(business: str, phone: str, jobId: str) -> str:
+    """
+    What an instance stopping in the middle of deleting a client leaves, the job running
+    with its lease run out.
+    """
+    path = f"businesses/{business}/clients/{phone}"
+    fsdb.document(path).set({"phone": phone, "deleted": True, "deleteJobId": jobId})
+    fsdb.document(f"{path}/messages/m1").set({"msg": "Hello"})
+    fsdb.document(get_job_path(business, jobId)).set(
+        asdict(Job(jobId=jobId, kind="delete", target=path, attempts=1))
+    )
+    return path
+
+
+def test_delete_job_resumed(business):
+    jobId = generate_id()
+    path = left_behind(business, "+14155550189", jobId)
+    job = wait_for_job(jobId)
+    assert job.status == JobStatus.done
+    assert job.attempts == 2
+    assert fsdb.document(path).get().to_dict() is None
+    assert fsdb.document(f"{path}/messages/m1").get().to_dict() is None
+
+
+def test_delete_job_cancelled(business):
+    jobId = generate_id()
+    phone = "+14155550190"
+    path = left_behind(business, phone, jobId)
+    _ = client.post(
+        "/clientManagement",
+        headers=bzz_headers,
+        json=asdict(MinimalClientModel(phone=phone, name="John")),
+    )
+    job = wait_for_job(jobId)
+    assert job.status == JobStatus.cancelled
+    assert fsdb.document(path).get().to_dict()["name"] == "John"
+    assert fsdb.document(f"{path}/messages/m1").get().to_dict() is not None
+
+
+def test_uow_create_race(business):
+    path = f"businesses/{business}/clients/+14155550193"
+    uow = UnitOfWork()
+    uow.create_if_absent(path, {"phone": "+14155550193", "name": "Second"})
+    uow.set(f"{path}/messages/m1", {"msg": "Hello"})
+    # Created between the caller's read and the commit
+    fsdb.document(path).set({"phone": "+14155550193", "name": "First"})
+    run(uow.commit())
+    assert fsdb.document(path).get().to_dict()["name"] == "First"
+    assert fsdb.document(f"{path}/messages/m1").get().to_dict() is not None
+
+
 def test_messaging(phone_number):
     response = TypeAdapter(CommonResponse).validate_python(
         client.post(
@@ -366,6 +874,26 @@ def test_messaging(phone_number):
     assert response.success is True
 
 
+def test_messaging_group(business):
+    group = generate_id(length=8)
+    clients = f"businesses/{business}/clients"
+    # Ids are what's messaged, a client without a phone field is still reached
+    fsdb.document(f"{clients}/+14155550191").set({"group": group})
+    fsdb.document(f"{clients}/+14155550192").set(
+        {"phone": "+14155550192", "group": group, "deleted": True}
+    )
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.post(
+            "/messaging",
+            headers=bzz_headers,
+            json=asdict(MessagingRequest(msg="test message", group_names=[group])),
+        ).json()
+    )
+    assert response.success is True
+    assert len(fsdb.collection(f"{clients}/+14155550191/messages").get()) == 1
+    assert len(fsdb.collection(f"{clients}/+14155550192/messages").get()) == 0
+
+
 todo: Todo | None = None
 
 
@@ -522,6 +1050,121 @@ def test_get_businesses2(business):
     assert present is False
 
 
+def claims_headers(
+    business: str, email: str, iat: int, exp: int | None = None
+) -> Dict[str, str]:
+    """
+    Acting for the business as a secondary user listed only in the claims of the token.
+    """
+    token = jwt_encode(
+        {
+            "uid": email,
+            "sub": email,
+            "email": email,
+            "iat": iat,
+            "exp": exp if exp is not None else iat + 3600,
+            "businesses": {business: ["Admin"]},
+        },
+        None,
+        algorithm="none",
+    )
+    return {"AccessKey": token, "OnBehalfOf": business}
+
+
+def test_claims_authorize(business):
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get(
+            "/calendars",
+            headers=claims_headers(business, "claims@example.com", int(time())),
+        ).json()
+    )
+    assert response.success is True
+
+
+def test_claims_expired(business):
+    iat = int(time()) - 3700
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get(
+            "/calendars",
+            headers=claims_headers(business, "claims@example.com", iat, iat + 3600),
+        ).json()
+    )
+    assert response.success is False
+
+
+def test_claims_old_token(business):
+    # Trusted until the token expires, however long ago it was issued
+    iat = int(time()) - 3000
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get(
+            "/calendars", headers=claims_headers(business, "claims@example.com", iat)
+        ).json()
+    )
+    assert response.success is True
+
+
+def test_claims_revoked_elsewhere(business, monkeypatch):
+    email = "claims4@example.com"
+    headers = claims_headers(business, email, int(time()) - 60)
+    # Recorded by another instance, only found once the revocations are reloaded
+    record_revocation(business, email, claims_cleared=True)
+    monkeypatch.setattr("common2.revocations", {})
+    monkeypatch.setattr("common2.revocations_loaded", 0.0)
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get("/calendars", headers=headers).json()
+    )
+    assert response.success is False
+
+
+def test_claims_removed(business):
+    headers = claims_headers(business, "claims2@example.com", int(time()))
+    _ = client.delete("/um/user/claims2@example.com", headers=bzz_headers)
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get("/calendars", headers=headers).json()
+    )
+    assert response.success is False
+
+
+def test_claims_written_on_removal(business, monkeypatch):
+    email = "claims3@example.com"
+    _ = client.post(
+        "/um/user", headers=bzz_headers, json=asdict(CreateUserRequest(email=email))
+    )
+    written: Dict[str, Dict] = {}
+    monkeypatch.setattr("um.offline", False)
+    monkeypatch.setattr(
+        "firebase_admin.auth.get_user_by_email",
+        lambda z: SimpleNamespace(uid=z, custom_claims={"other": True}),
+    )
+
+    def unavailable(uid: str, claims: Dict) -> None:
+        raise Exception("Unavailable")
+
+    # A failed write of the claims doesn't fail the removal, the revocation left
+    # uncleared keeps the claims from granting the business whenever the token was issued
+    monkeypatch.setattr("um.claims_backoff_secs", 0)
+    monkeypatch.setattr("firebase_admin.auth.set_custom_user_claims", unavailable)
+    headers = claims_headers(business, email, int(time()) + 5)
+    assert client.delete(f"/um/user/{email}", headers=bzz_headers).json() is None
+    members = BusinessUserManagement.get_users_part_of_businesses(business)
+    assert email not in [z.email for z in members]
+    revocation = fsdb.document(f"revocations/{email} {business}").get().to_dict()
+    assert revocation is not None and revocation["claimsCleared"] is False
+    response = TypeAdapter(CommonResponse).validate_python(
+        client.get("/calendars", headers=headers).json()
+    )
+    assert response.success is False
+
+    monkeypatch.setattr(
+        "firebase_admin.auth.set_custom_user_claims",
+        lambda uid, claims: written.update(claims),
+    )
+    _ = client.delete(f"/um/user/{email}", headers=bzz_headers)
+    assert written == {"other": True, "businesses": {}}
+    revocation = fsdb.document(f"revocations/{email} {business}").get().to_dict()
+    assert revocation is not None and revocation["claimsCleared"] is True
+
+
 def test_send_notification(phone_number2):
     to = [
         SendNotyf(
@@ -542,5 +1185,194 @@ def test_send_notification(phone_number2):
     assert len(response.result) == len(to)
 
 
+def slow_ops(caplog, monkeypatch) -> InstrumentedStorage:
+    """
+    A storage whose queries take 20ms, with every slow operation log entry captured.
+    """
+    get = MemoryQuery.get
+
+    def slow_get(self) -> list:
+        sleep(0.02)
+        return get(self)
+
+    monkeypatch.setattr(MemoryQuery, "get", slow_get)
+    monkeypatch.setattr("slowlog.threshold_ms", 10.0)
+    caplog.set_level("WARNING", logger="lookahead.slowops")
+    storage = InstrumentedStorage(MemoryStorage())
+    storage.document("businesses/a@b.com/calendars/x1").set({"name": "x1"})
+    return storage
+
+
+def slow_records(caplog) -> List[Dict]:
+    return [
+        loads(z.getMessage()) for z in caplog.records if z.name == "lookahead.slowops"
+    ]
+
+
+def test_slow_log_threshold(caplog, monkeypatch):
+    storage = slow_ops(caplog, monkeypatch)
+    _ = storage.document("businesses/a@b.com/calendars/x1").get()
+    assert slow_records(caplog) == []
+    _ = storage.collection("businesses/a@b.com/calendars").get()
+    (record,) = slow_records(caplog)
+    # Only the shape of the path, the ids are left out
+    assert record["op"] == "query.get"
+    assert record["path"] == "businesses/*/calendars"
+    assert record["resultCount"] == 1
+    assert record["ms"] >= 20
+    assert record["thresholdMs"] == 10.0
+    assert "a@b.com" not in caplog.text
+
+
+def test_slow_log_sample_rate(caplog, monkeypatch):
+    storage = slow_ops(caplog, monkeypatch)
+    monkeypatch.setattr("slowlog.sample_rate", 0.5)
+    monkeypatch.setattr("slowlog.random", lambda: 0.7)
+    _ = storage.collection("businesses").get()
+    assert slow_records(caplog) == []
+    monkeypatch.setattr("slowlog.random", lambda: 0.3)
+    _ = storage.collection("businesses").get()
+    assert len(slow_records(caplog)) == 1
+
+
+def test_slow_log_rate_limit(caplog, monkeypatch):
+    storage = slow_ops(caplog, monkeypatch)
+    now = [1000.0]
+    monkeypatch.setattr("slowlog.monotonic", lambda: now[0])
+    monkeypatch.setattr("slowlog.max_per_minute", 2)
+    monkeypatch.setattr("opstats.slow_log", SlowLog())
+    for _ in range(4):
+        _ = storage.collection("businesses").get()
+    assert [z["suppressed"] for z in slow_records(caplog)] == [0, 0]
+    # Half a minute refills one of the two entries a minute
+    now[0] += 30
+    for _ in range(2):
+        _ = storage.collection("businesses").get()
+    assert [z["suppressed"] for z in slow_records(caplog)] == [0, 0, 2]
+
+
+def test_get_docs_chunks(monkeypatch):
+    get_all = fsdb.get_all
+    chunks: List[int] = []
+
+    def counted(references: list) -> list:
+        chunks.append(len(references))
+        return get_all(references)
+
+    monkeypatch.setattr(fsdb, "get_all", counted)
+    batch = fsdb.batch()
+    for i in range(0, 250, 2):
+        batch.set(fsdb.document(f"chunks/{i:03}"), {"i": i})
+    batch.commit()
+    paths = [f"chunks/{i:03}" for i in reversed(range(250))]
+    docs = run(get_docs(paths))
+    assert sorted(chunks) == [50, 100, 100]
+    assert docs == [{"i": i} if i % 2 == 0 else None for i in reversed(range(250))]
+
+
+def test_preflight():
+    for headers in [
+        {"Origin": "https://book.example", "Access-Control-Request-Method": "POST"},
+        {"Access-Control-Request-Method": "POST"},
+    ]:
+        _t = client.options("/calendars", headers=headers)
+        assert _t.status_code == 204
+        assert _t.content == b""
+        assert _t.headers["access-control-allow-origin"] == "*"
+        assert "POST" in _t.headers["access-control-allow-methods"]
+        assert _t.headers["access-control-max-age"] == "86400"
+    # Without the request method it isn't a preflight, it goes through auth
+    _t = client.options("/calendars", headers={"Origin": "https://book.example"})
+    assert _t.json()["message"] == "Auth error, double check your token!"
+    assert _t.headers["access-control-allow-origin"] == "*"
+
+
+def test_public_path(business):
+    _t = client.get("/embed/business", params={"businessEmail": business})
+    assert _t.status_code == 200
+    assert _t.json()["email"] == business
+    assert _t.headers["access-control-allow-origin"] == "*"
+
+
+def test_protected_path_without_token():
+    _t = client.get("/calendars", headers={"Origin": "https://book.example"})
+    response = TypeAdapter(CommonResponse).validate_python(_t.json())
+    assert response.success is False
+    assert response.message == "Auth error, double check your token!"
+    assert _t.headers["access-control-allow-origin"] == "*"
+    assert "X-Firestore-Reads" in _t.headers["access-control-expose-headers"]
+
+
+async def released(event: Event, *waiters) -> list:
+    """
+    Runs the waiters together and lets their fetch finish once they have all started.
+    """
+
+    async def release() -> None:
+        await asyncio_sleep(0.1)
+        event.set()
+
+    results = await gather(*waiters, release(), return_exceptions=True)
+    return results[:-1]
+
+
+def test_singleflight_shared():
+    flight = SingleFlight("test_shared")
+    event = Event()
+    calls: List[int] = []
+
+    def fetch() -> int:
+        calls.append(1)
+        _ = event.wait(5)
+        return len(calls)
+
+    results = run(released(event, *(flight.do("k", fetch) for _ in range(5))))
+    assert results == [1] * 5
+    assert len(calls) == 1
+    assert (flight.stats.executed, flight.stats.coalesced) == (1, 4)
+    assert flight.calls == {}
+
+
+def test_singleflight_timeout_keeps_fetch():
+    flight = SingleFlight("test_timeout")
+    event = Event()
+    calls: List[int] = []
+
+    def fetch() -> int:
+        calls.append(1)
+        _ = event.wait(5)
+        return 42
+
+    async def waiters() -> list:
+        first = create_task(flight.do("k", fetch, timeout=0.05))
+        await asyncio_sleep(0)
+        task = flight.calls["k"]
+        results = await released(event, first, flight.do("k", fetch, timeout=5))
+        # The waiter timing out didn't cancel the fetch the other one was sharing
+        assert not task.cancelled()
+        return results
+
+    first, second = run(waiters())
+    assert isinstance(first, TimeoutError)
+    assert second == 42
+    assert len(calls) == 1
+    assert flight.stats.timeouts == 1
+
+
+def test_singleflight_exception():
+    flight = SingleFlight("test_exception")
+    event = Event()
+
+    def fetch() -> int:
+        _ = event.wait(5)
+        raise ValueError("Unavailable")
+
+    results = run(released(event, *(flight.do("k", fetch) for _ in range(3))))
+    assert all(isinstance(z, ValueError) for z in results)
+    assert len({id(z) for z in results}) == 1
+    assert flight.stats.executed == 1
+    assert flight.calls == {}
+
+
 # .\venv\Scripts\activate.ps1
 # pytest -s -p no:warnings
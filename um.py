@@ -1,17 +1,27 @@
-from asyncio import create_task, gather
+from asyncio import to_thread
 from dataclasses import asdict
+from logging import getLogger
+from time import sleep
 from typing import List, Tuple
 
 from fastapi import Request
 from fastapi.params import Header
 from fastapi.routing import APIRouter
+from firebase_admin import auth
 from google.cloud.firestore_v1.base_query import FieldFilter
-from pydantic import TypeAdapter
 from typing_extensions import Annotated
 
+from adapters import adapter, trusted
 from common import generate_id
-from common2 import find_subject, get_business
-from database import fsdb
+from common2 import (
+    find_subject,
+    forget_membership,
+    forget_revocation,
+    get_business_coalesced,
+    record_revocation,
+    to_business,
+)
+from database import fsdb, get_docs, offline
 from model import (
     Business,
     BusinessListResponse,
@@ -21,8 +31,14 @@ from model import (
     CreateUserRequest,
 )
 
+logger = getLogger("lookahead.auth")
+
 col_name = "businessusers"
 
+# Attempts at writing the claims of a user, the wait doubling between them
+claims_attempts = 3
+claims_backoff_secs = 0.5
+
 
 class BusinessUserManagement:
     def __init__(self, email: str, businessEmail: str) -> None:
@@ -41,7 +57,7 @@ class BusinessUserManagement:
             map(
                 lambda z: (
                     z.id,
-                    TypeAdapter(BusinessUser).validate_python(z.to_dict()),
+                    trusted(BusinessUser, z.to_dict()),
                 ),
                 docs,
             )
@@ -54,11 +70,66 @@ class BusinessUserManagement:
                 email=self.email, business=self.businessEmail, roles=roles
             )
             fsdb.document(f"{col_name}/{generate_id()}").set(asdict(bu))
+        if self.write_claims():
+            forget_revocation(business=self.businessEmail, email=self.email)
+        forget_membership(business=self.businessEmail, email=self.email)
 
     def remove_user(self) -> None:
+        """
+        The membership is deleted first and a revocation recorded, tokens claiming the
+        business aren't trusted for it from then on. Clearing the claims is best effort,
+        the revocation is only marked cleared once they were written.
+        """
         docs = self._get_doc_at_business()
         if len(docs) == 1:
             fsdb.document(f"{col_name}/{docs[0][0]}").delete()
+        record_revocation(
+            business=self.businessEmail, email=self.email, claims_cleared=False
+        )
+        forget_membership(business=self.businessEmail, email=self.email)
+        if self.write_claims():
+            record_revocation(
+                business=self.businessEmail, email=self.email, claims_cleared=True
+            )
+
+    def _write_claims_once(self) -> None:
+        try:
+            user = auth.get_user_by_email(self.email)
+        except auth.UserNotFoundError as _:
+            return
+        claims = dict(user.custom_claims or {})
+        claims["businesses"] = {
+            z.business: [str(x) for x in z.roles]
+            for z in BusinessUserManagement.get_businesses_user_part_of(
+                userEmail=self.email
+            )
+        }
+        auth.set_custom_user_claims(user.uid, claims)
+
+    def write_claims(self) -> bool:
+        """
+        Puts the businesses the user is part of, with their roles, in the custom claims of
+        the user so find_subject can authorize from the token. The map is rebuilt from the
+        collection rather than patched, and the user's other claims are kept.
+
+        Retried a few times, False when every attempt failed. Claims left stale are safe,
+        find_subject falls back to the collection for a business missing from them and a
+        revocation keeps them from granting a removed one.
+        """
+        if offline:
+            return True
+        for attempt in range(claims_attempts):
+            try:
+                self._write_claims_once()
+                return True
+            except Exception as e:
+                logger.warning(
+                    f"Writing the business claims of {self.email} failed, attempt "
+                    f"{attempt + 1} of {claims_attempts}: {e}"
+                )
+                if attempt + 1 < claims_attempts:
+                    sleep(claims_backoff_secs * 2**attempt)
+        return False
 
     @staticmethod
     def get_businesses_user_part_of(userEmail: str) -> List[BusinessUser]:
@@ -67,14 +138,7 @@ class BusinessUserManagement:
             .where(filter=FieldFilter("email", "==", userEmail))
             .get()
         )
-        return TypeAdapter(List[BusinessUser]).validate_python(
-            list(
-                map(
-                    lambda z: z.to_dict(),
-                    docs,
-                )
-            )
-        )
+        return [trusted(BusinessUser, z.to_dict()) for z in docs]
 
     @staticmethod
     def get_users_part_of_businesses(businessEmail: str) -> List[BusinessUser]:
@@ -83,14 +147,7 @@ class BusinessUserManagement:
             .where(filter=FieldFilter("business", "==", businessEmail))
             .get()
         )
-        return TypeAdapter(List[BusinessUser]).validate_python(
-            list(
-                map(
-                    lambda z: z.to_dict(),
-                    docs,
-                )
-            )
-        )
+        return [trusted(BusinessUser, z.to_dict()) for z in docs]
 
 
 router = APIRouter()
@@ -104,6 +161,8 @@ async def get_businesses(
     businesses: List[Business] = []
     if subject.business is not None:
         bpo: List[str] = [subject.business]
+        # Listed from the collection, the claims of the token miss the businesses added
+        # since it was issued
         bpo.extend(
             list(
                 map(
@@ -114,13 +173,11 @@ async def get_businesses(
                 )
             )
         )
+        bpo = list(dict.fromkeys(bpo))
 
-        async def get_business_async(businessEmail: str) -> Business | None:
-            return get_business(businessEmail=businessEmail)
-
-        tasks = [create_task(get_business_async(businessEmail=em)) for em in bpo]
-        businesses = TypeAdapter(List[Business]).validate_python(
-            filter(lambda z: z is not None, await gather(*tasks))
+        docs = await get_docs([f"businesses/{em}" for em in bpo])
+        businesses = adapter(List[Business]).validate_python(
+            filter(lambda z: z is not None, map(to_business, docs))
         )
         businesses.sort(key=lambda z: z.email)
     return BusinessListResponse(result=businesses)
@@ -134,12 +191,12 @@ async def create_user(
 ) -> None:
     subject = await find_subject(request=request)
     if subject.business is not None:
-        _t = get_business(businessEmail=subject.business)
+        _t = await get_business_coalesced(businessEmail=subject.business)
         if _t is not None:
             bum = BusinessUserManagement(
                 email=body.email, businessEmail=subject.business
             )
-            bum.add_user(roles=body.roles)
+            await to_thread(bum.add_user, roles=body.roles)
     return None
 
 
@@ -149,10 +206,10 @@ async def delete_user(
 ) -> None:
     subject = await find_subject(request=request)
     if subject.business is not None:
-        _t = get_business(businessEmail=subject.business)
+        _t = await get_business_coalesced(businessEmail=subject.business)
         if _t is not None:
             bum = BusinessUserManagement(email=email, businessEmail=subject.business)
-            bum.remove_user()
+            await to_thread(bum.remove_user)
     return None
 
 
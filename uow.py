@@ -0,0 +1,100 @@
+from asyncio import to_thread
+from typing import Any, Dict, List, Tuple
+
+from google.api_core.exceptions import AlreadyExists
+
+from database import fsdb, get_docs
+from jobs import is_deleted
+
+
+def _write(writer: Any, op: str, path: str, data: Dict | None) -> None:
+    ref = fsdb.document(path)
+    if op == "set":
+        writer.set(ref, data)
+    elif op == "create":
+        writer.create(ref, data)
+    elif op == "merge":
+        writer.set(ref, data, merge=True)
+    elif op == "update":
+        writer.update(ref, data)
+    elif op == "delete":
+        writer.delete(ref)
+
+
+class UnitOfWork:
+    """
+    Collects the writes of a request so they reach firestore in a single commit, a batch
+    where create_if_absent writes carry an exists precondition. Independent document reads
+    are issued together instead of one after the other.
+    """
+
+    # Firestore rejects batches with more than 500 operations
+    max_batch_ops = 500
+
+    def __init__(self) -> None:
+        self.ops: List[Tuple[str, str, Dict | None]] = []
+
+    def set(self, path: str, data: Dict) -> None:
+        self.ops.append(("set", path, data))
+
+    def merge(self, path: str, data: Dict) -> None:
+        self.ops.append(("merge", path, data))
+
+    def update(self, path: str, data: Dict) -> None:
+        self.ops.append(("update", path, data))
+
+    def delete(self, path: str) -> None:
+        self.ops.append(("delete", path, None))
+
+    def create_if_absent(self, path: str, data: Dict) -> None:
+        """
+        Writes the document only when it doesn't exist yet, or is marked deleted, the write
+        then replaces the mark and the delete job leaves it be. Meant for documents the
+        caller read and found absent, the batch creates them with a precondition. When one
+        exists by then, or is marked, the commit is redone as a transaction reading them
+        first, still in one commit with the rest.
+        """
+        self.ops.append(("create", path, data))
+
+    async def read(self, *paths: str) -> List[Dict | None]:
+        """
+        Reads the given documents in one go, results are in the same order as the paths.
+        """
+        return await get_docs(list(paths))
+
+    def _commit(self, ops: List[Tuple[str, str, Dict | None]]) -> None:
+        for i in range(0, len(ops), self.max_batch_ops):
+            batch = fsdb.batch()
+            for op, path, data in ops[i : i + self.max_batch_ops]:
+                _write(batch, op, path, data)
+            batch.commit()
+
+    def _transaction(self, ops: List[Tuple[str, str, Dict | None]]) -> None:
+        def run(transaction: Any) -> None:
+            creates = [fsdb.document(p) for op, p, _ in ops if op == "create"]
+            existing = {
+                z.reference.path
+                for z in transaction.get_all(creates)
+                if z.exists and not is_deleted(z.to_dict())
+            }
+            for op, path, data in ops:
+                if op != "create":
+                    _write(transaction, op, path, data)
+                elif path not in existing:
+                    _write(transaction, "set", path, data)
+
+        fsdb.run_transaction(run)
+
+    def _commit_creating(self, ops: List[Tuple[str, str, Dict | None]]) -> None:
+        try:
+            self._commit(ops)
+        except AlreadyExists as _:
+            # Created meanwhile, or marked deleted, the rest of the writes still go in
+            self._transaction(ops)
+
+    async def commit(self) -> None:
+        ops, self.ops = self.ops, []
+        if any(op == "create" for op, _, _ in ops):
+            await to_thread(self._commit_creating, ops)
+        elif len(ops) > 0:
+            await to_thread(self._commit, ops)
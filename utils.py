@@ -1,44 +1,58 @@
 from dataclasses import asdict
 
-from pydantic import TypeAdapter
-
-from database import fsdb
+from adapters import adapter, trusted
+from jobs import is_deleted
 from model import Business, ClientModel, MinimalClientModel
+from uow import UnitOfWork
 
 
-def cross_sync_business_and_client(
-    business: str, user_phone: str, mcm: MinimalClientModel | None = None
+async def cross_sync_business_and_client(
+    business: str,
+    user_phone: str,
+    mcm: MinimalClientModel | None = None,
+    uow: UnitOfWork | None = None,
 ):
+    """
+    Makes sure the client exists under the business and the business exists under the user.
+    The two documents are read along with the ones they are built from, in a single
+    get_all, and only the missing ones are written, with a precondition so a concurrent
+    sync can't be overwritten. When a unit of work is given the writes are only queued on
+    it, the caller commits.
+    """
+    _uow = uow if uow is not None else UnitOfWork()
+
     cm: ClientModel | None = None
     if mcm is not None:
-        cm = TypeAdapter(ClientModel).validate_python(asdict(mcm))
-    user_path = f"users/{user_phone}"
+        cm = trusted(ClientModel, asdict(mcm))
+    phone = mcm.phone if mcm is not None and mcm.phone is not None else user_phone
+
+    client_path = f"businesses/{business}/clients/{phone}"
+    link_path = f"users/{phone}/businesses/{business}"
+    bzz_path = f"businesses/{business}"
     if cm is None:
-        _t = fsdb.document(user_path).get().to_dict()
-        if _t is not None:
-            cm = TypeAdapter(ClientModel).validate_python(_t)
+        _c, _l, _b, _u = await _uow.read(
+            client_path, link_path, bzz_path, f"users/{user_phone}"
+        )
+        if _u is not None:
+            cm = adapter(ClientModel).validate_python(_u)
+    else:
+        _c, _l, _b = await _uow.read(client_path, link_path, bzz_path)
     if cm is None:
         cm = ClientModel(phone=user_phone)
-    if mcm is not None and mcm.phone is not None:
-        cm.phone = mcm.phone
+    cm.phone = phone
 
     bzz: Business | None = None
-    bzz_path = f"businesses/{business}"
-    _t = fsdb.document(bzz_path).get().to_dict()
-    if _t is not None:
-        bzz = TypeAdapter(Business).validate_python(
-            {**_t, "docID": business, "business": business}
+    if _b is not None:
+        bzz = adapter(Business).validate_python(
+            {**_b, "docID": business, "business": business}
         )
     if bzz is None:
         bzz = Business(docID=business, email=business, business=business)
 
-    if cm is not None and bzz is not None:
-        _p = f"businesses/{bzz.business}/clients/{cm.phone}"
-        _t = fsdb.document(_p).get().to_dict()
-        if _t is None:
-            fsdb.document(_p).set(asdict(cm))
+    if _c is None or is_deleted(_c):
+        _uow.create_if_absent(client_path, asdict(cm))
+    if _l is None:
+        _uow.create_if_absent(link_path, asdict(bzz))
 
-        _p = f"users/{cm.phone}/businesses/{bzz.business}"
-        _t = fsdb.document(_p).get().to_dict()
-        if _t is None:
-            fsdb.document(_p).set(asdict(bzz))
+    if uow is None:
+        await _uow.commit()